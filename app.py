@@ -9,8 +9,12 @@ import os
 import json
 import hmac
 import hashlib
-import requests
 from chatbot_engine import ChatbotEngine
+from messenger_client import MessengerClient
+from workers import WorkerPool, SenderDispatcher
+from webhook_queue import WebhookQueue, QueueConsumer
+from dedupe_index import DedupeIndex
+from rate_limiter import split_quota
 from werkzeug.utils import secure_filename
 import threading
 import time
@@ -23,78 +27,178 @@ UPLOAD_FOLDER = 'data'
 ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
+# Số worker gunicorn/uvicorn (cả hai đọc WEB_CONCURRENCY khi không truyền --workers);
+# mỗi worker có bucket quota Gemini riêng nên quota được chia đều cho các worker
+SERVER_WORKERS = max(1, int(os.environ.get('WEB_CONCURRENCY', '1')))
+PROMPT_OVERHEAD_TOKENS = 2000  # Token của system prompt và tin nhắn mới, ngoài dữ liệu sản phẩm và lịch sử
 
 # Biến global
 chatbot = None
+worker_pool = None  # Pool xử lý tin nhắn webhook, tạo khi khởi động
+dispatcher = None  # Gộp và xử lý tuần tự tin nhắn theo người gửi
+webhook_queue = None  # Hàng đợi bền vững giữa webhook và worker pool
+consumer = None  # Lấy tin nhắn từ hàng đợi đưa vào dispatcher
+dedupe = None  # mid các tin nhắn đã trả lời (bỏ qua khi Facebook gửi lại)
+signature_key = None  # (app secret, HMAC-SHA256 đã nạp key) dùng chung cho mọi webhook POST
+signature_stats = {'verified': 0, 'rejected': 0, 'unchecked': 0}
+signature_lock = threading.Lock()
+metrics_providers = {}  # Tên -> hàm trả về thống kê riêng của chế độ đang chạy cho /api/metrics
+messenger = None  # HTTP client dùng chung cho Messenger Send API
+chatbot_lock = threading.Lock()
+config_mtime = None  # mtime của config.json lần load gần nhất
 config = {
     'gemini_api_key': '',
     'fb_page_token': '',
     'fb_verify_token': 'my_secret_verify_token',  # Tự đặt
     'fb_app_secret': '',
+    'worker_count': 4,  # Số thread xử lý tin nhắn đồng thời
+    'queue_size': 100,  # Số tin nhắn tối đa chờ xử lý
+    'debounce_seconds': 1.5,  # Chờ gộp các tin nhắn liên tiếp của cùng khách
+    'asgi_concurrency': 64,  # Chế độ ASGI: số khách được xử lý đồng thời trên event loop
+    'webhook_queue_path': 'webhook_queue.db',  # Hàng đợi tin nhắn webhook (SQLite, dùng chung giữa các worker)
+    'webhook_queue_lease': 60,  # Tin nhắn đã lấy mà chưa trả lời xong sau 60s thì xử lý lại (giây)
+    'webhook_max_attempts': 5,  # Số lần xử lý lại tối đa một tin nhắn lỗi
+    'dedupe_window': 86400,  # Nhớ mid tin nhắn đã trả lời trong 1 ngày (giây)
+    'dedupe_max_entries': 200000,  # Số mid tối đa được nhớ
+    'http_connect_timeout': 3.05,  # Timeout kết nối Graph API (giây)
+    'http_read_timeout': 10,  # Timeout chờ Graph API trả lời (giây)
+    'http_retries': 3,  # Số lần thử lại khi Graph API lỗi 5xx / 429
+    'graph_api_url': 'https://graph.facebook.com/v18.0',
+    'graph_batch': True,  # Gửi text + hình trong một Graph API batch request
+    'direct_answer_threshold': 1.2,  # Điểm khớp để trả lời thẳng từ Excel, không gọi Gemini
+    'retrieval_k': 8,  # Số câu hỏi-trả lời liên quan nhất đưa vào prompt
+    'context_token_budget': 2000,  # Ngân sách token cho dữ liệu sản phẩm trong prompt
+    'matcher': 'fuzzy',  # 'fuzzy' (difflib) hoặc 'semantic' (vector, cần numpy)
+    'history_max_users': 10000,  # Số khách tối đa giữ lịch sử chat
+    'history_ttl': 86400,  # Quên lịch sử của khách im lặng quá 1 ngày (giây)
+    'history_max_bytes': 16384,  # Dung lượng lịch sử tối đa của mỗi khách (byte)
+    'history_backend': 'sqlite',  # 'sqlite' (dùng chung giữa các worker gunicorn) hoặc 'memory'
+    'history_token_budget': 1000,  # Số token lịch sử chat gửi kèm mỗi lần gọi Gemini
+    'llm_timeout': 15,  # Chờ Gemini tối đa (giây), quá hạn thì trả lời bằng dữ liệu Excel
+    'llm_concurrency': 4,  # Số lời gọi Gemini đồng thời tối đa (theo quota)
+    'llm_hedge_percentile': 0.95,  # Gọi thêm khi Gemini chậm hơn p95 gần đây (null để tắt)
+    'llm_rpm': 15,  # Quota Gemini: request mỗi phút của cả API key (mỗi worker dùng llm_rpm / WEB_CONCURRENCY, tối thiểu 1)
+    'llm_tpm': 1000000,  # Quota Gemini: token mỗi phút của cả API key (mỗi worker dùng llm_tpm / WEB_CONCURRENCY)
+    'llm_user_rpm': 4,  # Số lần gọi Gemini mỗi phút cho một khách
+    'llm_quota_wait': 2.0,  # Chờ quota nạp lại tối đa (giây) trước khi trả lời bằng dữ liệu Excel
 }
 
 def load_config():
-    """Load cấu hình từ file"""
-    global config
-    if os.path.exists('config.json'):
-        with open('config.json', 'r') as f:
-            config.update(json.load(f))
+    """
+    Load cấu hình từ file
+    
+    Returns:
+        bool: True nếu file đã thay đổi kể từ lần load trước
+    """
+    global config, config_mtime
+    try:
+        mtime = os.path.getmtime('config.json')
+    except OSError:
+        return False
+    if mtime == config_mtime:
+        return False
+    with open('config.json', 'r') as f:
+        config.update(json.load(f))
+    config_mtime = mtime
+    return True
 
 def save_config():
     """Lưu cấu hình"""
+    global config_mtime
     with open('config.json', 'w') as f:
         json.dump(config, f, indent=2)
+    config_mtime = os.path.getmtime('config.json')
 
 def init_chatbot():
-    """Khởi tạo chatbot"""
+    """
+    Khởi tạo chatbot (singleton)
+    Chỉ tạo engine mới lần đầu; khi đổi API key thì cập nhật engine đang chạy
+    để giữ dữ liệu đã load và lịch sử hội thoại.
+    """
     global chatbot
-    if config['gemini_api_key']:
-        chatbot = ChatbotEngine(config['gemini_api_key'], UPLOAD_FOLDER)
-        return True
-    return False
+    if not config['gemini_api_key']:
+        return False
+    with chatbot_lock:
+        if chatbot is None:
+            llm_rpm, llm_tpm = split_quota(config['llm_rpm'], config['llm_tpm'], SERVER_WORKERS,
+                                           config['context_token_budget'] + config['history_token_budget']
+                                           + PROMPT_OVERHEAD_TOKENS)
+            chatbot = ChatbotEngine(config['gemini_api_key'], UPLOAD_FOLDER,
+                                    direct_answer_threshold=config['direct_answer_threshold'],
+                                    retrieval_k=config['retrieval_k'],
+                                    context_token_budget=config['context_token_budget'],
+                                    matcher=config['matcher'],
+                                    history_max_users=config['history_max_users'],
+                                    history_ttl=config['history_ttl'],
+                                    history_max_bytes=config['history_max_bytes'],
+                                    history_backend=config['history_backend'],
+                                    history_token_budget=config['history_token_budget'],
+                                    llm_timeout=config['llm_timeout'],
+                                    llm_concurrency=config['llm_concurrency'],
+                                    llm_hedge_percentile=config['llm_hedge_percentile'],
+                                    llm_rpm=llm_rpm,
+                                    llm_tpm=llm_tpm,
+                                    llm_user_rpm=config['llm_user_rpm'],
+                                    llm_quota_wait=config['llm_quota_wait'])
+        elif chatbot.api_key != config['gemini_api_key']:
+            chatbot.update_api_key(config['gemini_api_key'])
+    return True
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 def send_messenger_message(recipient_id: str, message_text: str, image_url: str = None):
-    """Gửi tin nhắn qua Facebook Messenger API"""
+    """
+    Gửi tin nhắn qua Facebook Messenger API
+    
+    Returns:
+        bool: True nếu tin nhắn đầu tiên (câu trả lời) đã được Facebook nhận
+    """
+    messages = outgoing_messages(messenger, message_text, image_url)
+    if not messages:
+        return messages is not None
+    
+    # Text + hình gửi trong một batch request, đúng thứ tự
+    return check_sent(messages, messenger.send_messages(recipient_id, messages))
+
+def outgoing_messages(client, message_text: str, image_url: str = None):
+    """
+    Phần chung của gửi trả lời (chế độ đồng bộ và ASGI): các tin nhắn cần gửi qua client
+    
+    Returns:
+        list: Tin nhắn text rồi hình (rỗng nếu không có gì để gửi), None nếu chưa cấu hình Page Token
+    """
     if not config['fb_page_token']:
         print("Chưa cấu hình Facebook Page Token")
-        return False
+        return None
     
-    url = f"https://graph.facebook.com/v18.0/me/messages?access_token={config['fb_page_token']}"
-    
-    # Gửi text
+    # Token có thể đã được đổi qua Admin Panel
+    client.page_token = config['fb_page_token']
+    return reply_messages(message_text, image_url)
+
+def check_sent(messages: list, statuses: list) -> bool:
+    """
+    Câu trả lời đã tới khách chưa: chỉ xét tin nhắn đầu tiên,
+    lỗi gửi hình thì không thử lại cả lượt (sẽ gửi trùng câu trả lời)
+    """
+    print(f"Sent {len(messages)} message(s): {statuses}")
+    return statuses[0] is not None and 200 <= statuses[0] < 300
+
+def reply_messages(message_text: str, image_url: str = None) -> list:
+    """Các tin nhắn Messenger của một câu trả lời (text rồi hình)"""
+    messages = []
     if message_text:
-        payload = {
-            "recipient": {"id": recipient_id},
-            "message": {"text": message_text}
-        }
-        try:
-            response = requests.post(url, json=payload)
-            print(f"Sent message: {response.status_code}")
-        except Exception as e:
-            print(f"Error sending message: {e}")
-            return False
+        messages.append({"text": message_text})
     
     # Gửi hình ảnh nếu có
     if image_url:
-        payload = {
-            "recipient": {"id": recipient_id},
-            "message": {
-                "attachment": {
-                    "type": "image",
-                    "payload": {"url": image_url, "is_reusable": True}
-                }
+        messages.append({
+            "attachment": {
+                "type": "image",
+                "payload": {"url": image_url, "is_reusable": True}
             }
-        }
-        try:
-            response = requests.post(url, json=payload)
-            print(f"Sent image: {response.status_code}")
-        except Exception as e:
-            print(f"Error sending image: {e}")
-    
-    return True
+        })
+    return messages
 
 # ==================== GIAO DIỆN WEB ====================
 
@@ -512,8 +616,9 @@ ADMIN_HTML = """
 @app.route('/')
 def admin_panel():
     """Trang quản lý chính"""
-    load_config()
-    init_chatbot()
+    # Worker khác có thể đã lưu cấu hình mới - chỉ áp dụng khi file thực sự đổi
+    if load_config():
+        init_chatbot()
     
     stats = chatbot.get_stats() if chatbot else {'total_qa': 0, 'total_conversations': 0, 'total_abbreviations': 0}
     files = [f for f in os.listdir(UPLOAD_FOLDER) if f.endswith(('.xlsx', '.xls'))] if os.path.exists(UPLOAD_FOLDER) else []
@@ -560,9 +665,9 @@ def upload_file():
         os.makedirs(UPLOAD_FOLDER, exist_ok=True)
         file.save(os.path.join(UPLOAD_FOLDER, filename))
         
-        # Reload chatbot data
+        # Chỉ load lại file vừa upload
         if chatbot:
-            chatbot.reload_data()
+            chatbot.reload_file(filename)
         
         return jsonify({'success': True, 'message': f'✅ Đã upload {filename}'})
     
@@ -577,7 +682,7 @@ def delete_file():
     if os.path.exists(filepath):
         os.remove(filepath)
         if chatbot:
-            chatbot.reload_data()
+            chatbot.remove_file(os.path.basename(filepath))
         return jsonify({'success': True, 'message': f'✅ Đã xóa {filename}'})
     
     return jsonify({'success': False, 'message': 'File không tồn tại'})
@@ -597,9 +702,22 @@ def test_chatbot():
         return jsonify({'response': '⚠️ Vui lòng cấu hình Gemini API Key trước', 'image': None})
     
     message = request.json.get('message', '')
-    response, image = chatbot.get_response('test_user', message)
+    result = chatbot.respond('test_user', message)
     
-    return jsonify({'response': response, 'image': image})
+    return jsonify({'response': result['answer'], 'image': result['image'],
+                    'path': result['path'], 'latency_ms': result['latency_ms']})
+
+@app.route('/api/metrics')
+def metrics():
+    """Thống kê hàng đợi xử lý tin nhắn"""
+    stats = {
+        'webhook_queue': webhook_queue.get_stats(),
+        'dedupe': dedupe.get_stats(),
+        'signature': dict(signature_stats),
+    }
+    for name, provider in metrics_providers.items():
+        stats[name] = provider()
+    return jsonify(stats)
 
 @app.route('/download-template')
 def download_template():
@@ -656,10 +774,103 @@ def webhook_verify():
     
     return 'Forbidden', 403
 
+def process_messages(sender_id: str, events: list):
+    """
+    Trả lời các tin nhắn liên tiếp của một khách bằng một lần gọi chatbot
+    Chỉ xóa tin nhắn khỏi hàng đợi sau khi đã gửi trả lời; lỗi thì để hàng đợi thử lại.
+    """
+    fresh, message_text = prepare_messages(events)
+    try:
+        sent = True
+        if message_text:
+            result = chatbot.respond(sender_id, message_text)
+            log_reply(sender_id, result)
+            sent = send_messenger_message(sender_id, result['answer'], result['image'])
+    except Exception:
+        settle_messages(sender_id, events, fresh, None)
+        raise
+    settle_messages(sender_id, events, fresh, sent)
+
+def prepare_messages(events: list) -> tuple:
+    """
+    Phần đầu của một lượt xử lý (dùng chung cho chế độ đồng bộ và ASGI)
+    
+    Returns:
+        (tin nhắn chưa trả lời, nội dung gửi chatbot; rỗng nếu không cần gọi chatbot)
+    """
+    # Tin nhắn lấy lại sau khi hết lease có thể đã được worker khác trả lời
+    fresh = dedupe.filter(events, stage='worker')
+    message_text = '\n'.join(event['text'] for event in fresh) if chatbot else ''
+    return fresh, message_text
+
+def log_reply(sender_id: str, result: dict):
+    print(f"🤖 Trả lời {sender_id} qua '{result['path']}' trong {result['latency_ms']}ms")
+
+def settle_messages(sender_id: str, events: list, fresh: list, sent):
+    """
+    Kết thúc một lượt xử lý (dùng chung cho chế độ đồng bộ và ASGI)
+    Đã gửi trả lời thì ghi nhận mid rồi xóa khỏi hàng đợi, không thì để hàng đợi thử lại.
+    
+    Args:
+        sent: True đã gửi trả lời, False gửi không được (báo RuntimeError),
+            None khi nơi gọi đang raise lỗi của chính nó
+    """
+    ids = [event['id'] for event in events]
+    if sent:
+        # Ghi nhận mid trước khi xóa khỏi hàng đợi để không có lúc nào tin gửi lại lọt qua
+        dedupe.add([event['mid'] for event in fresh])
+        webhook_queue.ack(ids)
+        return
+    webhook_queue.nack(ids)
+    if sent is False:
+        raise RuntimeError(f"Không gửi được câu trả lời cho {sender_id}")
+
+def verify_signature(signature: str, read_body) -> bool:
+    """
+    Kiểm tra X-Hub-Signature-256 trên body gốc (trước khi parse JSON)
+    Header sai định dạng bị từ chối trước khi đọc body; key HMAC chỉ nạp một lần,
+    mỗi request chỉ copy trạng thái đã nạp rồi băm body.
+    
+    Args:
+        signature: Giá trị header X-Hub-Signature-256
+        read_body: Hàm trả về body gốc (bytes), chỉ gọi khi header hợp lệ
+    """
+    global signature_key
+    secret = config['fb_app_secret']
+    if not secret:
+        # Chưa cấu hình App Secret thì không kiểm tra được
+        with signature_lock:
+            signature_stats['unchecked'] += 1
+        return True
+    
+    ok = False
+    if signature.startswith('sha256=') and len(signature) == 71:
+        key = signature_key
+        if key is None or key[0] != secret:
+            key = signature_key = (secret, hmac.new(secret.encode(), digestmod=hashlib.sha256))
+        mac = key[1].copy()
+        mac.update(read_body())
+        ok = hmac.compare_digest(mac.hexdigest().encode(), signature[7:].encode())
+    
+    with signature_lock:
+        signature_stats['verified' if ok else 'rejected'] += 1
+    return ok
+
 @app.route('/webhook', methods=['POST'])
 def webhook_handler():
-    """Xử lý tin nhắn từ Facebook Messenger"""
-    data = request.json
+    """
+    Nhận tin nhắn từ Facebook Messenger
+    Chỉ ghi vào hàng đợi rồi trả 200 ngay (không chờ Gemini); ghi lỗi thì trả 500 để Facebook gửi lại.
+    """
+    if not verify_signature(request.headers.get('X-Hub-Signature-256', ''), request.get_data):
+        return 'Invalid signature', 403
+    
+    enqueue_events(parse_webhook_events(request.json))
+    return 'OK', 200
+
+def parse_webhook_events(data: dict) -> list:
+    """Lấy các tin nhắn text trong một webhook POST"""
+    events = []
     
     if data.get('object') == 'page':
         for entry in data.get('entry', []):
@@ -670,28 +881,59 @@ def webhook_handler():
                 if 'message' in event and 'text' in event['message']:
                     message_text = event['message']['text']
                     print(f"📩 Received: {message_text} from {sender_id}")
-                    
-                    if chatbot:
-                        # Xử lý trong thread riêng để không block
-                        def process_message():
-                            response, image = chatbot.get_response(sender_id, message_text)
-                            send_messenger_message(sender_id, response, image)
-                        
-                        thread = threading.Thread(target=process_message)
-                        thread.start()
-    
-    return 'OK', 200
+                    events.append({'mid': event['message'].get('mid'),
+                                   'sender_id': sender_id, 'text': message_text})
+    return events
+
+def enqueue_events(events: list) -> int:
+    """Ghi tin nhắn vào hàng đợi bền vững (lỗi ghi thì để exception lan ra: trả 500, Facebook gửi lại)"""
+    if not events or not chatbot:
+        return 0
+    # Facebook gửi lại tin đã trả lời: bỏ qua trước khi vào hàng đợi
+    return webhook_queue.put(dedupe.filter(events))
+
+# ==================== KHỞI TẠO ====================
+
+# Khởi tạo một lần khi import (cả khi chạy dưới gunicorn)
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+load_config()
+init_chatbot()
+dedupe = DedupeIndex(config['webhook_queue_path'],
+                     window=config['dedupe_window'],
+                     max_entries=config['dedupe_max_entries'])
+webhook_queue = WebhookQueue(config['webhook_queue_path'],
+                             lease=config['webhook_queue_lease'],
+                             max_attempts=config['webhook_max_attempts'])
+
+def start_sync_workers():
+    """Chế độ đồng bộ (gunicorn app:app): worker pool và thread lấy tin nhắn từ hàng đợi"""
+    global worker_pool, dispatcher, consumer, messenger
+    worker_pool = WorkerPool(config['worker_count'], config['queue_size'], name='webhook')
+    dispatcher = SenderDispatcher(worker_pool, process_messages, debounce=config['debounce_seconds'],
+                                  queue_size=config['queue_size'])
+    # Xử lý tuần tự theo người gửi trong worker pool; chỉ lấy khỏi hàng đợi số tin nhắn
+    # dispatcher còn nhận được (tính cả tin đang gộp và đang chờ pool)
+    consumer = QueueConsumer(webhook_queue, lambda event: dispatcher.dispatch(event['sender_id'], event),
+                             capacity=dispatcher.capacity)
+    messenger = MessengerClient(config['fb_page_token'],
+                                pool_size=config['worker_count'],
+                                connect_timeout=config['http_connect_timeout'],
+                                read_timeout=config['http_read_timeout'],
+                                retries=config['http_retries'],
+                                base_url=config['graph_api_url'],
+                                use_batch=config['graph_batch'])
+    metrics_providers['workers'] = worker_pool.get_stats
+    metrics_providers['senders'] = dispatcher.get_stats
+    metrics_providers['messenger'] = messenger.get_stats
+    consumer.start()
+
+# asgi_app.py đặt CHATBOT_SERVING=asgi trước khi import: hàng đợi do event loop xử lý, không tạo thread
+if os.environ.get('CHATBOT_SERVING') != 'asgi':
+    start_sync_workers()
 
 # ==================== MAIN ====================
 
 if __name__ == '__main__':
-    # Tạo thư mục data
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    
-    # Load cấu hình
-    load_config()
-    init_chatbot()
-    
     print("=" * 50)
     print("🤖 Facebook Messenger Chatbot Server")
     print("=" * 50)
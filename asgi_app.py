@@ -0,0 +1,256 @@
+"""
+Chế độ chạy ASGI: nhận webhook, gọi Gemini và gửi Messenger trên cùng một event loop
+Chạy (mỗi worker một event loop):
+    uvicorn asgi_app:app --host 0.0.0.0 --port $PORT
+    gunicorn asgi_app:app -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:$PORT
+
+POST /webhook được xử lý async (kiểm tra chữ ký, ghi hàng đợi bền vững như app.py);
+các route khác (admin panel, API) vẫn là Flask, chạy trong thread pool qua asgiref.
+Số khách xử lý đồng thời giới hạn bởi config['asgi_concurrency'] thay vì số thread,
+số lời gọi Gemini đồng thời vẫn giới hạn bởi llm_concurrency.
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import Callable, Dict, List
+
+from asgiref.wsgi import WsgiToAsgi
+
+# Phải đặt trước khi import app: không khởi động worker pool / thread consumer của chế độ đồng bộ
+os.environ['CHATBOT_SERVING'] = 'asgi'
+
+import app as server
+from messenger_client import AsyncMessengerClient
+from webhook_queue import QueueConsumer
+
+flask_app = WsgiToAsgi(server.app)
+dispatcher = None  # Gộp và xử lý tin nhắn theo người gửi trên event loop
+messenger = None  # HTTP client async cho Messenger Send API
+consumer = None  # Lấy tin nhắn từ hàng đợi bền vững đưa cho dispatcher
+consumer_task = None
+wakeup = None  # Báo consumer có tin nhắn mới do worker này ghi
+
+
+class AsyncSenderDispatcher:
+    """
+    Bản async của SenderDispatcher: gộp các tin nhắn của một khách đến cách nhau không quá
+    `debounce` giây (chờ tối đa 3 × debounce như SenderDispatcher), mỗi khách một task xử lý
+    tuần tự; tổng số lượt xử lý đồng thời giới hạn bởi semaphore.
+    """
+
+    def __init__(self, handler: Callable, debounce: float = 1.5, max_concurrency: int = 64,
+                 queue_size: int = 100, max_pending: int = 20):
+        """
+        Args:
+            handler: Coroutine xử lý handler(sender_id, [tin nhắn theo thứ tự])
+            debounce: Số giây chờ thêm tin nhắn trước khi xử lý
+            max_concurrency: Số khách được xử lý đồng thời
+            queue_size: Số tin nhắn tối đa đã nhận mà chưa xử lý xong
+            max_pending: Số tin nhắn tối đa đang chờ cho một người gửi
+        """
+        self.handler = handler
+        self.debounce = debounce
+        self.max_wait = debounce * 3  # Không chờ quá lâu nếu khách nhắn liên tục
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.max_pending = max_pending
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._pending: Dict[str, List] = {}  # sender_id -> tin nhắn chờ xử lý
+        self._due: Dict[str, List[float]] = {}  # sender_id -> [lúc nhận tin đầu, thời điểm xử lý]
+        self._tasks: Dict[str, asyncio.Task] = {}  # sender_id -> task đang xử lý khách đó
+
+        self.in_flight = 0  # Tin nhắn đã nhận mà chưa xử lý xong
+        self.active = 0
+        self.peak_active = 0
+        self.received = 0
+        self.batches = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def capacity(self) -> int:
+        """Số tin nhắn còn nhận được"""
+        return max(0, self.queue_size - self.in_flight)
+
+    def dispatch(self, sender_id: str, message) -> bool:
+        """
+        Thêm tin nhắn vào hàng đợi của người gửi (gọi trên event loop)
+
+        Returns:
+            bool: False nếu người gửi có quá nhiều tin nhắn đang chờ
+        """
+        pending = self._pending.setdefault(sender_id, [])
+        if len(pending) >= self.max_pending:
+            self.dropped += 1
+            return False
+        pending.append(message)
+        now = time.monotonic()
+        first_at = self._due.setdefault(sender_id, [now, now])[0]
+        self._due[sender_id][1] = min(now + self.debounce, first_at + self.max_wait)
+        self.received += 1
+        self.in_flight += 1
+        if sender_id not in self._tasks:
+            self._tasks[sender_id] = asyncio.ensure_future(self._run(sender_id))
+        return True
+
+    async def _run(self, sender_id: str):
+        try:
+            # Tin nhắn đến trong lúc đang xử lý thì xử lý tiếp ở vòng sau
+            while sender_id in self._pending:
+                # Có tin nhắn mới trong lúc chờ thì lùi thời điểm xử lý
+                while (wait := self._due[sender_id][1] - time.monotonic()) > 0:
+                    await asyncio.sleep(wait)
+                messages = self._pending.pop(sender_id)
+                del self._due[sender_id]
+                async with self._semaphore:
+                    self.batches += 1
+                    self.coalesced += len(messages) - 1
+                    self.active += 1
+                    self.peak_active = max(self.peak_active, self.active)
+                    try:
+                        await self.handler(sender_id, messages)
+                    except Exception as e:
+                        print(f"❌ Lỗi khi xử lý tin nhắn của {sender_id}: {e}")
+                        self.failed += 1
+                    finally:
+                        self.active -= 1
+                        self.in_flight -= len(messages)
+        finally:
+            del self._tasks[sender_id]
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê xử lý tin nhắn trên event loop"""
+        return {
+            'max_concurrency': self.max_concurrency,
+            'active_senders': len(self._tasks),
+            'active': self.active,
+            'peak_active': self.peak_active,
+            'in_flight': self.in_flight,
+            'received': self.received,
+            'batches': self.batches,
+            'coalesced': self.coalesced,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+
+async def send_messenger_message(recipient_id: str, message_text: str, image_url: str = None) -> bool:
+    """Giống app.send_messenger_message nhưng gửi không chặn event loop"""
+    messages = server.outgoing_messages(messenger, message_text, image_url)
+    if not messages:
+        return messages is not None
+    return server.check_sent(messages, await messenger.send_messages(recipient_id, messages))
+
+
+async def process_messages(sender_id: str, events: list):
+    """Giống app.process_messages; phần dùng SQLite (prepare/settle của app.py) chạy trong thread pool"""
+    fresh, message_text = await asyncio.to_thread(server.prepare_messages, events)
+    try:
+        sent = True
+        if message_text:
+            chatbot = server.chatbot
+            # Engine có thể được tạo sau khi server chạy (nhập API key ở Admin Panel)
+            chatbot.use_event_loop(asyncio.get_running_loop())
+            result = await chatbot.respond_async(sender_id, message_text)
+            server.log_reply(sender_id, result)
+            sent = await send_messenger_message(sender_id, result['answer'], result['image'])
+    except Exception:
+        await asyncio.to_thread(server.settle_messages, sender_id, events, fresh, None)
+        raise
+    await asyncio.to_thread(server.settle_messages, sender_id, events, fresh, sent)
+
+
+async def startup():
+    global dispatcher, messenger, consumer, consumer_task, wakeup
+    config = server.config
+    loop = asyncio.get_running_loop()
+    if server.chatbot:
+        server.chatbot.use_event_loop(loop)
+    wakeup = asyncio.Event()
+    dispatcher = AsyncSenderDispatcher(process_messages,
+                                       debounce=config['debounce_seconds'],
+                                       max_concurrency=config['asgi_concurrency'],
+                                       queue_size=config['queue_size'])
+    messenger = AsyncMessengerClient(config['fb_page_token'],
+                                     pool_size=config['asgi_concurrency'],
+                                     connect_timeout=config['http_connect_timeout'],
+                                     read_timeout=config['http_read_timeout'],
+                                     retries=config['http_retries'],
+                                     base_url=config['graph_api_url'],
+                                     use_batch=config['graph_batch'])
+    server.metrics_providers['asgi'] = dispatcher.get_stats
+    server.metrics_providers['messenger_async'] = messenger.get_stats
+    consumer = QueueConsumer(server.webhook_queue, lambda event: dispatcher.dispatch(event['sender_id'], event),
+                             capacity=dispatcher.capacity)
+    consumer_task = asyncio.ensure_future(consumer.run_async(wakeup))
+    print(f"⚡ Chế độ ASGI: tối đa {config['asgi_concurrency']} khách xử lý đồng thời")
+
+
+async def shutdown():
+    consumer.stop()
+    consumer_task.cancel()
+    await messenger.close()
+
+
+async def respond(send, status: int, body: bytes):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8')]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def read_body(receive, limit: int):
+    """Đọc body của request (None nếu vượt limit byte)"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def webhook(scope, receive, send):
+    """Giống app.webhook_handler: chỉ kiểm tra chữ ký và ghi hàng đợi, trả 200 ngay"""
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    body = await read_body(receive, server.app.config['MAX_CONTENT_LENGTH'])
+    if body is None:
+        return await respond(send, 413, b'Payload Too Large')
+    if not server.verify_signature(headers.get('x-hub-signature-256', ''), lambda: body):
+        return await respond(send, 403, b'Invalid signature')
+    try:
+        data = json.loads(body)
+    except ValueError:
+        data = None
+    if not isinstance(data, dict):
+        return await respond(send, 400, b'Bad Request')
+
+    if await asyncio.to_thread(server.enqueue_events, server.parse_webhook_events(data)):
+        wakeup.set()
+    await respond(send, 200, b'OK')
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await startup()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """Ứng dụng ASGI: webhook POST xử lý async, còn lại chuyển cho Flask"""
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http' and scope['path'] == '/webhook' and scope['method'] == 'POST':
+        return await webhook(scope, receive, send)
+    return await flask_app(scope, receive, send)
@@ -0,0 +1,634 @@
+"""
+Benchmark các thành phần của chatbot
+Chạy: python benchmark.py <tên benchmark> [tùy chọn]
+"""
+
+import argparse
+import json
+import random
+import re
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from knowledge_base import KnowledgeEntry
+
+
+# ==================== GRAPH API GIẢ ====================
+
+class StubGraphServer:
+    """Server Graph API giả chạy local: đếm request, số kết nối và thêm độ trễ"""
+
+    def __init__(self, latency: float = 0.05):
+        self.latency = latency
+        self.requests = 0
+        self.connections = set()
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # Giữ kết nối keep-alive như Graph API thật
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with stub.lock:
+                    stub.requests += 1
+                    stub.connections.add(self.client_address)
+                time.sleep(stub.latency)
+                form = parse_qs(body.decode('utf-8'))
+                if 'batch' in form:
+                    batch = json.loads(form['batch'][0])
+                    result = [{'code': 200, 'body': '{"message_id": "m"}'} for _ in batch]
+                else:
+                    result = {'recipient_id': '1', 'message_id': 'm'}
+                data = json.dumps(result).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v18.0"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.connections = set()
+
+    def close(self):
+        self.server.shutdown()
+
+
+def bench_messenger(args):
+    """So sánh gửi tuần tự và gửi batch cho câu trả lời text + hình"""
+    from messenger_client import MessengerClient
+
+    stub = StubGraphServer(latency=args.latency)
+    messages = [
+        {"text": "Dạ giá sản phẩm là 150.000đ ạ"},
+        {"attachment": {"type": "image", "payload": {"url": "https://example.com/a.jpg", "is_reusable": True}}},
+    ]
+    print(f"📨 {args.replies} câu trả lời (text + hình), độ trễ server {args.latency * 1000:.0f}ms")
+    for use_batch in (False, True):
+        stub.reset()
+        client = MessengerClient('token', base_url=stub.url, use_batch=use_batch)
+        start = time.perf_counter()
+        for i in range(args.replies):
+            client.send_messages(str(i), messages)
+        elapsed = time.perf_counter() - start
+        mode = 'batch' if use_batch else 'tuần tự'
+        print(f"  {mode:8s}: {stub.requests} request, {len(stub.connections)} kết nối, "
+              f"{elapsed / args.replies * 1000:.1f}ms/câu trả lời")
+    stub.close()
+
+
+# ==================== KNOWLEDGE BASE GIẢ ====================
+
+PRODUCT_TYPES = ['áo thun', 'áo sơ mi', 'quần jean', 'váy', 'đầm', 'áo khoác', 'giày', 'túi xách', 'mũ', 'quần short']
+PRODUCT_STYLES = ['cổ tròn', 'cổ tim', 'ống rộng', 'ôm', 'form rộng', 'công sở', 'dạo phố', 'thể thao', 'basic', 'oversize']
+PRODUCT_COLORS = ['đen', 'trắng', 'xanh', 'hồng', 'be', 'nâu', 'xám', 'đỏ', 'vàng', 'tím']
+QUESTION_TEMPLATES = [
+    ('Giá {p} bao nhiêu?', 'giá, tiền, bao nhiêu', 'Giá cả'),
+    ('{p} có size gì?', 'size, kích thước', 'Sản phẩm'),
+    ('{p} còn hàng không?', 'còn hàng, có sẵn', 'Sản phẩm'),
+    ('Chất liệu {p} là gì?', 'chất liệu, vải', 'Sản phẩm'),
+    ('Ship {p} mất mấy ngày?', 'ship, giao hàng', 'Vận chuyển'),
+]
+# Cách khách hàng viết tắt (ngược với từ điển viết tắt của engine)
+SHORTHANDS = [('sản phẩm', 'sp'), ('bao nhiêu', 'bn'), ('không', 'k'), ('vận chuyển', 'vc'), ('được', 'dc')]
+FILLERS = ['shop ơi', 'cho e hỏi', 'ạ', 'vậy', 'nha']
+
+
+def generate_entries(count: int, seed: int = 42):
+    """Sinh knowledge base gồm `count` câu hỏi-trả lời sản phẩm khác nhau"""
+    rng = random.Random(seed)
+    products = [f"{t} {s} {c}" for t in PRODUCT_TYPES for s in PRODUCT_STYLES for c in PRODUCT_COLORS]
+    rng.shuffle(products)
+    entries = []
+    for i in range(count):
+        product = products[i % len(products)]
+        template, keywords, category = QUESTION_TEMPLATES[(i // len(products)) % len(QUESTION_TEMPLATES)]
+        entries.append(KnowledgeEntry(
+            'bench.xlsx',
+            question=template.format(p=product).capitalize(),
+            answer=f"Dạ {product} giá {rng.randint(10, 99) * 10}k ạ",
+            keywords=keywords,
+            category=category,
+        ))
+    return entries
+
+
+def paraphrase(question: str, rng: random.Random) -> str:
+    """Biến đổi câu hỏi như khách hàng thật: viết tắt, bỏ dấu câu, đảo/bớt từ, thêm từ đệm"""
+    text = question.lower().rstrip('?')
+    for full, short in SHORTHANDS:
+        if rng.random() < 0.7:
+            text = text.replace(full, short)
+    words = text.split()
+    if len(words) > 4 and rng.random() < 0.5:
+        del words[rng.randrange(len(words))]
+    if rng.random() < 0.3:
+        i = rng.randrange(len(words) - 1)
+        words[i], words[i + 1] = words[i + 1], words[i]
+    if rng.random() < 0.6:
+        words.insert(0, rng.choice(FILLERS[:2]))
+    if rng.random() < 0.6:
+        words.append(rng.choice(FILLERS[2:]))
+    return ' '.join(words)
+
+
+def make_engine(**kwargs):
+    """ChatbotEngine với thư mục dữ liệu tạm (không gọi Gemini)"""
+    from chatbot_engine import ChatbotEngine
+    return ChatbotEngine('benchmark', tempfile.mkdtemp(prefix='chatbot-bench-'), **kwargs)
+
+
+def bench_match(args):
+    """So sánh fuzzy matcher và semantic matcher: độ chính xác và thời gian mỗi truy vấn"""
+    from semantic_index import SemanticIndex
+
+    entries = generate_entries(args.entries)
+    rng = random.Random(7)
+    queries = [(i, paraphrase(entries[i]['question'], rng))
+               for i in rng.sample(range(len(entries)), min(args.queries, len(entries)))]
+    print(f"🔎 {len(entries)} câu hỏi, {len(queries)} truy vấn diễn đạt lại")
+
+    for matcher in ('fuzzy', 'semantic'):
+        engine = make_engine(matcher=matcher)
+        start = time.perf_counter()
+        engine._set_knowledge_base(entries)
+        build = time.perf_counter() - start
+        if matcher == 'semantic':
+            # Lần khởi động sau: ma trận đọc từ cache trên đĩa
+            start = time.perf_counter()
+            SemanticIndex(engine.segments[''].match_index, engine.cache_folder)
+            print(f"  semantic: đọc lại chỉ mục từ đĩa {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        correct = 0
+        latencies = []
+        for expected, query in queries:
+            start = time.perf_counter()
+            match = engine.find_best_match(query)
+            latencies.append(time.perf_counter() - start)
+            if match is entries[expected]:
+                correct += 1
+        latencies.sort()
+        print(f"  {matcher:8s}: đúng {correct / len(queries):.1%}, "
+              f"build {build * 1000:.0f}ms, "
+              f"trung bình {sum(latencies) / len(latencies) * 1000:.2f}ms/truy vấn, "
+              f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:.2f}ms")
+
+
+def write_workbook(path: str, entries, sheets: int = 1):
+    """Ghi entries ra file Excel theo mẫu của create_template.py (chia đều vào các sheet)"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    per_sheet = -(-len(entries) // sheets)
+    for n in range(sheets):
+        sheet = workbook.create_sheet(f"Sheet {n + 1}")
+        sheet.append(['câu hỏi', 'câu trả lời', 'hình ảnh', 'từ khóa', 'danh mục'])
+        for e in entries[n * per_sheet:(n + 1) * per_sheet]:
+            sheet.append([e['question'], e['answer'], None, e['keywords'], e['category']])
+    workbook.save(path)
+
+
+def legacy_read_excel(path):
+    """Cách đọc cũ: pandas + iterrows, chỉ sheet đầu tiên"""
+    import os
+    import pandas as pd
+
+    df = pd.read_excel(path)
+    df.columns = [col.lower().strip() for col in df.columns]
+    entries = []
+    for _, row in df.iterrows():
+        entry = {
+            'source_file': os.path.basename(path),
+            'question': str(row.get('câu hỏi', row.get('question', ''))).strip(),
+            'answer': str(row.get('câu trả lời', row.get('answer', ''))).strip(),
+            'image': str(row.get('hình ảnh', row.get('image', ''))).strip(),
+            'keywords': str(row.get('từ khóa', row.get('keywords', ''))).strip(),
+            'category': str(row.get('danh mục', row.get('category', ''))).strip(),
+        }
+        if entry['question'] and entry['question'] != 'nan':
+            entries.append(entry)
+    return entries
+
+
+def bench_ingest(args):
+    """Đọc file Excel lớn: pandas + iterrows so với đọc theo cột bằng openpyxl read-only"""
+    import os
+    from pathlib import Path
+    from knowledge_base import read_excel_entries
+
+    path = os.path.join(tempfile.mkdtemp(prefix='chatbot-bench-'), 'bench.xlsx')
+    write_workbook(path, generate_entries(args.rows), sheets=1)
+    print(f"📊 File {args.rows} dòng ({os.path.getsize(path) / 1e6:.1f}MB)")
+
+    for name, reader in (('pandas iterrows', legacy_read_excel),
+                         ('openpyxl theo cột', lambda p: read_excel_entries(Path(p)))):
+        start = time.perf_counter()
+        entries = reader(path)
+        elapsed = time.perf_counter() - start
+        print(f"  {name:18s}: {len(entries)} entry trong {elapsed:.2f}s "
+              f"({len(entries) / elapsed:,.0f} dòng/giây)")
+
+
+def bench_memory(args):
+    """Bộ nhớ mỗi entry: dict + chuỗi 'nan' (cách cũ), KnowledgeEntry, snapshot mmap"""
+    import gc
+    import os
+    import tracemalloc
+    from pathlib import Path
+    from kb_snapshot import Snapshot, snapshot_path, write_snapshot
+    from knowledge_base import load_segment
+    from match_index import MatchIndex
+
+    folder = tempfile.mkdtemp(prefix='chatbot-bench-')
+    path = os.path.join(folder, 'bench.xlsx')
+    write_workbook(path, generate_entries(args.rows), sheets=1)
+    segment = load_segment(Path(path))
+    snapshot_file = snapshot_path(folder, 'bench.xlsx')
+    write_snapshot(snapshot_file, segment, MatchIndex(segment.entries, str.lower), '')
+
+    def retained(load):
+        """Số byte còn giữ sau khi load (không tính bộ nhớ tạm lúc đọc file)"""
+        gc.collect()
+        tracemalloc.start()
+        data = load()
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return data, size
+
+    print(f"🧠 {args.rows} câu hỏi-trả lời")
+    for name, load in (('dict (pandas)', lambda: legacy_read_excel(path)),
+                       ('KnowledgeEntry', lambda: load_segment(Path(path)).entries),
+                       ('snapshot mmap', lambda: Snapshot(snapshot_file))):
+        data, size = retained(load)
+        print(f"  {name:15s}: {size / args.rows:6.0f} byte/entry ({size / 1e6:.1f}MB)")
+    print(f"  (file snapshot {snapshot_file.stat().st_size / 1e6:.1f}MB, các worker dùng chung qua page cache)")
+
+
+# ==================== GEMINI GIẢ ====================
+
+class FakeGeminiModel:
+    """Model giả cùng giao diện generate_content: độ trễ ngẫu nhiên với một phần lời gọi rất chậm"""
+
+    class Response:
+        def __init__(self, text: str):
+            self.text = text
+
+    def __init__(self, latency: float = 0.05, slow_latency: float = 2.0, slow_ratio: float = 0.05,
+                 seed: int = 1):
+        self.latency = latency
+        self.slow_latency = slow_latency
+        self.slow_ratio = slow_ratio
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def generate_content(self, contents):
+        with self.lock:
+            self.calls += 1
+            slow = self.rng.random() < self.slow_ratio
+        time.sleep(self.slow_latency if slow else self.latency * (0.5 + self.rng.random()))
+        return self.Response("Dạ em gửi anh/chị thông tin ạ")
+
+
+class FakeAsyncGeminiModel(FakeGeminiModel):
+    """FakeGeminiModel có thêm generate_content_async (như model Gemini thật), đếm số lời gọi đồng thời"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.active = 0
+        self.peak = 0
+
+    async def generate_content_async(self, contents):
+        import asyncio
+        with self.lock:
+            self.calls += 1
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            slow = self.rng.random() < self.slow_ratio
+        try:
+            await asyncio.sleep(self.slow_latency if slow else self.latency * (0.5 + self.rng.random()))
+        finally:
+            with self.lock:
+                self.active -= 1
+        return self.Response("Dạ em gửi anh/chị thông tin ạ")
+
+
+def bench_llm(args):
+    """Latency gọi Gemini giả (có đuôi chậm): không hedging so với hedging, deadline"""
+    from concurrent.futures import ThreadPoolExecutor
+    from llm_client import LLMClient
+
+    print(f"🤖 {args.calls} lời gọi, {args.threads} thread, {args.slow_ratio:.0%} lời gọi chậm "
+          f"{args.slow_latency:.1f}s, deadline {args.timeout:.1f}s")
+    for hedge in (None, args.hedge_percentile):
+        model = FakeGeminiModel(args.latency, args.slow_latency, args.slow_ratio)
+        client = LLMClient(args.timeout, args.concurrency, hedge)
+        latencies = []
+
+        def call(_):
+            start = time.perf_counter()
+            try:
+                client.generate(model, [])
+            except TimeoutError:
+                pass
+            latencies.append(time.perf_counter() - start)
+
+        with ThreadPoolExecutor(args.threads) as pool:
+            list(pool.map(call, range(args.calls)))
+        latencies.sort()
+        stats = client.get_stats()
+        name = 'không hedging' if hedge is None else f'hedging p{hedge * 100:.0f}'
+        print(f"  {name:14s}: p50 {latencies[len(latencies) // 2] * 1000:.0f}ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.0f}ms, "
+              f"quá hạn {stats['timeouts']}, hedge {stats['hedged']} (thắng {stats['hedge_wins']}), "
+              f"{model.calls} lời gọi tới model")
+
+
+def legacy_expand(abbreviations, text: str) -> str:
+    """Cách mở rộng viết tắt cũ: regex cho từng từ, tra dict từng từ một"""
+    expanded = []
+    for word in text.lower().split():
+        clean_word = re.sub(r'[^\w\s]', '', word)
+        expanded.append(abbreviations.get(clean_word, word))
+    return ' '.join(expanded)
+
+
+def bench_normalize(args):
+    """Số tin nhắn/giây khi mở rộng viết tắt: regex từng từ, trie, trie + cache"""
+    from normalizer import Normalizer
+
+    abbreviations = make_engine().abbreviations
+    entries = generate_entries(args.entries)
+    rng = random.Random(11)
+    # Khách hay hỏi lại cùng một câu nên tin nhắn lặp lại: lấy mẫu có hoàn lại từ `distinct` câu
+    pool = [paraphrase(entries[rng.randrange(len(entries))]['question'], rng) for _ in range(args.distinct)]
+    messages = [rng.choice(pool) for _ in range(args.messages)]
+    print(f"🔤 {len(abbreviations)} từ viết tắt, {len(messages)} tin nhắn "
+          f"({len(set(messages))} tin khác nhau)")
+
+    normalizer = Normalizer(abbreviations)
+    mismatches = sum(legacy_expand(abbreviations, m) != normalizer.expand_uncached(m) for m in messages)
+    runs = [
+        ('regex từng từ', lambda m: legacy_expand(abbreviations, m)),
+        ('trie', normalizer.expand_uncached),
+        ('trie + cache', normalizer.expand),
+    ]
+    for name, expand in runs:
+        start = time.perf_counter()
+        for message in messages:
+            expand(message)
+        elapsed = time.perf_counter() - start
+        print(f"  {name:14s}: {len(messages) / elapsed:,.0f} tin nhắn/giây")
+    stats = normalizer.get_stats()
+    print(f"  cache: tỉ lệ trúng {stats['cache_hit_rate']:.1%}, kết quả khác cách cũ: {mismatches}")
+
+
+# ==================== WEBHOOK ====================
+
+def load_app(**overrides):
+    """Import app.py trong thư mục tạm với config.json cho benchmark (không gửi Messenger thật)"""
+    import os
+    os.chdir(tempfile.mkdtemp(prefix='chatbot-app-'))
+    config = {'gemini_api_key': 'benchmark', 'fb_page_token': '', 'debounce_seconds': 0.05,
+              'llm_rpm': 100000, 'llm_user_rpm': 100000}
+    config.update(overrides)
+    with open('config.json', 'w') as f:
+        json.dump(config, f)
+    import app as server
+    return server
+
+
+def webhook_payload(sender_id: str, mid: str, text: str) -> dict:
+    return {'object': 'page', 'entry': [{'messaging': [
+        {'sender': {'id': sender_id}, 'message': {'mid': mid, 'text': text}}]}]}
+
+
+def bench_webhook(args):
+    """Latency của webhook POST khi Gemini nhanh và khi Gemini chậm, thời gian xử lý hết hàng đợi"""
+    # Tin chưa gửi được trả lời thì được thử lại: cần Graph API (giả) để hàng đợi xử lý hết
+    stub = StubGraphServer(latency=0.0)
+    server = load_app(llm_timeout=args.slow_latency * 2, fb_page_token='token', graph_api_url=stub.url)
+    client = server.app.test_client()
+    print(f"📥 {args.posts} webhook POST, {args.senders} khách")
+    for name, latency in (('Gemini nhanh', args.latency), ('Gemini chậm', args.slow_latency)):
+        server.chatbot.model = FakeGeminiModel(latency, latency, 0.0)
+        latencies = []
+        start = time.perf_counter()
+        for i in range(args.posts):
+            payload = webhook_payload(f"user-{i % args.senders}", f"{name}-{i}", 'Shop ơi giá bn ạ')
+            request_start = time.perf_counter()
+            client.post('/webhook', json=payload)
+            latencies.append(time.perf_counter() - request_start)
+        while server.webhook_queue.get_stats()['pending']:
+            time.sleep(0.05)
+        drained = time.perf_counter() - start
+        latencies.sort()
+        print(f"  {name:12s}: webhook p50 {latencies[len(latencies) // 2] * 1000:.2f}ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f}ms, "
+              f"trả lời hết sau {drained:.1f}s")
+
+    # Facebook gửi lại các tin đã trả lời: bỏ qua trước khi vào hàng đợi
+    calls = server.chatbot.model.calls
+    latencies = []
+    for i in range(args.posts):
+        payload = webhook_payload(f"user-{i % args.senders}", f"Gemini nhanh-{i}", 'Shop ơi giá bn ạ')
+        request_start = time.perf_counter()
+        client.post('/webhook', json=payload)
+        latencies.append(time.perf_counter() - request_start)
+    latencies.sort()
+    stats = server.webhook_queue.get_stats()
+    dedupe = server.dedupe.get_stats()
+    print(f"  {'gửi lại':12s}: webhook p50 {latencies[len(latencies) // 2] * 1000:.2f}ms, "
+          f"bỏ {dedupe['duplicates_total']} tin trùng, hàng đợi nhận {stats['enqueued']} tin, "
+          f"{server.chatbot.model.calls - calls} lời gọi Gemini thêm")
+
+
+def bench_signature(args):
+    """Chi phí kiểm tra chữ ký webhook: request không ký / ký sai / ký đúng, copy HMAC so với tạo mới"""
+    import hashlib
+    import hmac
+
+    secret = 'benchmark-app-secret'
+    server = load_app(fb_app_secret=secret)
+    server.chatbot.model = FakeGeminiModel(0.0, 0.0, 0.0)
+    client = server.app.test_client()
+    # Payload kích thước thật: một tin nhắn text kèm metadata
+    body = json.dumps(webhook_payload('user-0', 'mid-0', 'Shop ơi giá bn ạ ' * 20)).encode()
+    valid = 'sha256=' + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+    print(f"🔏 {args.requests} request mỗi loại, body {len(body)} byte")
+    cases = [('không ký', {}), ('ký sai', {'X-Hub-Signature-256': 'sha256=' + '0' * 64}),
+             ('ký đúng', {'X-Hub-Signature-256': valid})]
+    for name, headers in cases:
+        start = time.perf_counter()
+        for _ in range(args.requests):
+            client.post('/webhook', data=body, headers=headers, content_type='application/json')
+        elapsed = time.perf_counter() - start
+        print(f"  {name:9s}: {elapsed / args.requests * 1e6:.0f}µs/request")
+
+    key = hmac.new(secret.encode(), digestmod=hashlib.sha256)
+    for name, make in (('tạo HMAC mới', lambda: hmac.new(secret.encode(), digestmod=hashlib.sha256)),
+                       ('copy HMAC', key.copy)):
+        start = time.perf_counter()
+        for _ in range(args.requests * 10):
+            mac = make()
+            mac.update(body)
+            hmac.compare_digest(mac.hexdigest().encode(), valid[7:].encode())
+        print(f"  {name:12s}: {(time.perf_counter() - start) / (args.requests * 10) * 1e6:.2f}µs/lần kiểm tra")
+    print(f"  thống kê: {server.signature_stats}")
+
+
+def bench_serving(args):
+    """
+    Load test qua HTTP thật: một worker đồng bộ (như gunicorn sync) so với một worker ASGI (uvicorn)
+    Mỗi hội thoại là một khách gửi một tin nhắn; Gemini và Graph API là server giả có độ trễ.
+    """
+    import os
+    import subprocess
+    import sys
+
+    if args.mode == 'both':
+        print(f"🚦 {args.conversations} hội thoại, {args.clients} client gửi webhook, "
+              f"Gemini {args.latency * 1000:.0f}ms, Graph API {args.graph_latency * 1000:.0f}ms")
+        for mode in ('sync', 'asgi'):
+            # Mỗi chế độ chạy trong process riêng vì app.py khởi tạo trạng thái toàn cục khi import
+            command = [sys.executable, __file__, 'serving', '--mode', mode]
+            for name in ('conversations', 'clients', 'latency', 'graph_latency'):
+                command += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+            output = subprocess.run(command, capture_output=True, text=True).stdout
+            print(next((line for line in output.splitlines() if line.startswith('  ')), output[-500:]))
+        return
+
+    import requests as http
+    from concurrent.futures import ThreadPoolExecutor
+
+    stub = StubGraphServer(latency=args.graph_latency)
+    if args.mode == 'asgi':
+        # Như khi chạy asgi_app: app.py không tạo worker pool / thread consumer
+        os.environ['CHATBOT_SERVING'] = 'asgi'
+    server = load_app(fb_page_token='token', graph_api_url=stub.url, llm_timeout=60,
+                      llm_concurrency=args.conversations, llm_hedge_percentile=None,
+                      queue_size=args.conversations, debounce_seconds=0.01)
+    model = server.chatbot.model = FakeAsyncGeminiModel(args.latency, args.latency, 0.0)
+
+    if args.mode == 'sync':
+        from werkzeug.serving import make_server
+        # Worker sync của gunicorn xử lý từng request một; tin nhắn do worker pool xử lý
+        httpd = make_server('127.0.0.1', 0, server.app, threaded=False)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        port = httpd.server_port
+        per_worker = f"{server.config['worker_count']} thread"
+    else:
+        import socket
+        import uvicorn
+        import asgi_app
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        uv = uvicorn.Server(uvicorn.Config(asgi_app.app, log_level='warning', lifespan='on'))
+        threading.Thread(target=uv.run, kwargs={'sockets': [sock]}, daemon=True).start()
+        while not uv.started:
+            time.sleep(0.01)
+        per_worker = f"asgi_concurrency {server.config['asgi_concurrency']}"
+
+    url = f"http://127.0.0.1:{port}/webhook"
+    session = http.Session()
+    latencies = []
+
+    def post(i):
+        # Mỗi khách hỏi một câu khác nhau để không trúng cache câu trả lời
+        payload = webhook_payload(f"user-{i}", f"mid-{i}", f"Shop ơi mẫu số {i} giá bn ạ")
+        request_start = time.perf_counter()
+        session.post(url, json=payload)
+        latencies.append(time.perf_counter() - request_start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.clients) as pool:
+        list(pool.map(post, range(args.conversations)))
+    while stub.requests < args.conversations:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"  {args.mode:5s} ({per_worker}): {args.conversations / elapsed:.1f} hội thoại/giây, "
+          f"tối đa {model.peak} hội thoại đồng thời, xong sau {elapsed:.1f}s, "
+          f"webhook p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms")
+
+
+# ==================== MAIN ====================
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest='bench', required=True)
+
+    p = sub.add_parser('messenger', help='Gửi tin nhắn qua Graph API giả')
+    p.add_argument('--replies', type=int, default=50)
+    p.add_argument('--latency', type=float, default=0.05)
+    p.set_defaults(func=bench_messenger)
+
+    p = sub.add_parser('match', help='Fuzzy matcher và semantic matcher')
+    p.add_argument('--entries', type=int, default=2000)
+    p.add_argument('--queries', type=int, default=200)
+    p.set_defaults(func=bench_match)
+
+    p = sub.add_parser('ingest', help='Đọc file Excel lớn')
+    p.add_argument('--rows', type=int, default=50000)
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser('memory', help='Bộ nhớ của knowledge base')
+    p.add_argument('--rows', type=int, default=20000)
+    p.set_defaults(func=bench_memory)
+
+    p = sub.add_parser('llm', help='Gọi Gemini giả có độ trễ')
+    p.add_argument('--calls', type=int, default=400)
+    p.add_argument('--threads', type=int, default=4)
+    p.add_argument('--latency', type=float, default=0.05)
+    p.add_argument('--slow-latency', type=float, default=2.0)
+    p.add_argument('--slow-ratio', type=float, default=0.05)
+    p.add_argument('--timeout', type=float, default=1.5)
+    p.add_argument('--concurrency', type=int, default=8)
+    p.add_argument('--hedge-percentile', type=float, default=0.9)
+    p.set_defaults(func=bench_llm)
+
+    p = sub.add_parser('normalize', help='Mở rộng từ viết tắt')
+    p.add_argument('--entries', type=int, default=2000)
+    p.add_argument('--messages', type=int, default=50000)
+    p.add_argument('--distinct', type=int, default=3000)
+    p.set_defaults(func=bench_normalize)
+
+    p = sub.add_parser('webhook', help='Webhook với hàng đợi bền vững')
+    p.add_argument('--posts', type=int, default=300)
+    p.add_argument('--senders', type=int, default=50)
+    p.add_argument('--latency', type=float, default=0.02)
+    p.add_argument('--slow-latency', type=float, default=1.0)
+    p.set_defaults(func=bench_webhook)
+
+    p = sub.add_parser('signature', help='Kiểm tra chữ ký webhook')
+    p.add_argument('--requests', type=int, default=2000)
+    p.set_defaults(func=bench_signature)
+
+    p = sub.add_parser('serving', help='Load test worker đồng bộ so với worker ASGI')
+    p.add_argument('--mode', choices=['both', 'sync', 'asgi'], default='both')
+    p.add_argument('--conversations', type=int, default=200)
+    p.add_argument('--clients', type=int, default=8)
+    p.add_argument('--latency', type=float, default=1.0)
+    p.add_argument('--graph-latency', type=float, default=0.05)
+    p.set_defaults(func=bench_serving)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,32 +4,130 @@ Sử dụng Gemini API + Dữ liệu từ Excel
 Author: Claude AI Assistant
 """
 
+import asyncio
 import os
 import json
 import re
-import pandas as pd
+import hashlib
+import threading
+import time
 import google.generativeai as genai
 from typing import Optional, Dict, List, Tuple
 from pathlib import Path
-import difflib
+from knowledge_base import KnowledgeSegment, load_segment
+from kb_snapshot import open_snapshot, prune_snapshots, snapshot_path, write_snapshot
+from match_index import MatchIndex, SegmentedIndex
+from semantic_index import SemanticIndex, prune_cache
+from semantic_index import is_available as semantic_available
+from response_cache import ResponseCache
+from conversation_store import ConversationStore, SQLiteConversationStore
+from llm_client import LLMClient
+from rate_limiter import QuotaLimiter
+from normalizer import Normalizer
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng nhanh số token (tiếng Việt khoảng 3 ký tự / token)"""
+    return len(text) // 3 + 1
+
+
+def contents_tokens(contents: List[Dict]) -> int:
+    """Ước lượng số token của danh sách lượt hội thoại gửi Gemini"""
+    return sum(estimate_tokens(part) for message in contents for part in message['parts'])
+
+
+SYSTEM_RULES = """Bạn là nhân viên tư vấn bán hàng chuyên nghiệp, thân thiện.
+Nhiệm vụ: Trả lời câu hỏi của khách hàng dựa trên thông tin sản phẩm/dịch vụ được cung cấp.
+
+QUY TẮC QUAN TRỌNG:
+1. Trả lời ngắn gọn, thân thiện, dùng emoji phù hợp
+2. Xưng hô: "em" (nhân viên) - "anh/chị" hoặc "mình" (khách hàng)
+3. Nếu không có thông tin, nói "Em sẽ kiểm tra và phản hồi anh/chị sau ạ"
+4. Nếu khách hỏi giá, luôn trả lời cụ thể nếu có trong dữ liệu
+5. Cuối câu thường thêm "ạ" hoặc "nha" để thân thiện
+6. KHÔNG bịa thông tin không có trong dữ liệu
+"""
+
 
 class ChatbotEngine:
-    def __init__(self, api_key: str, data_folder: str = "data"):
+    def __init__(self, api_key: str, data_folder: str = "data",
+                 cache_size: int = 1000, cache_ttl: float = 3600,
+                 direct_answer_threshold: Optional[float] = 1.2,
+                 retrieval_k: int = 8, context_token_budget: int = 2000,
+                 matcher: str = "fuzzy", history_max_users: int = 10000,
+                 history_ttl: float = 86400, history_max_bytes: int = 16384,
+                 history_backend: str = "memory", history_token_budget: int = 1000,
+                 llm_timeout: float = 15.0, llm_concurrency: int = 4,
+                 llm_hedge_percentile: Optional[float] = 0.95, llm_rpm: float = 15,
+                 llm_tpm: float = 1000000, llm_user_rpm: float = 4, llm_quota_wait: float = 2.0):
         """
         Khởi tạo Chatbot Engine
         
         Args:
             api_key: Gemini API Key
             data_folder: Thư mục chứa file Excel dữ liệu
+            cache_size: Số câu trả lời tối đa lưu trong cache
+            cache_ttl: Thời gian giữ một câu trả lời trong cache (giây)
+            direct_answer_threshold: Điểm khớp từ đó trả lời thẳng từ knowledge base,
+                không gọi Gemini (1.2 = khớp từ khóa + độ giống 0.9; None để tắt)
+            retrieval_k: Số câu hỏi-trả lời liên quan nhất đưa vào prompt
+            context_token_budget: Số token tối đa cho phần thông tin sản phẩm trong prompt
+            matcher: "fuzzy" (difflib) hoặc "semantic" (vector TF-IDF n-gram, cần numpy)
+            history_max_users: Số khách tối đa giữ lịch sử chat
+            history_ttl: Quên lịch sử của khách im lặng quá thời gian này (giây)
+            history_max_bytes: Số byte lịch sử tối đa của mỗi khách
+            history_backend: "memory" (riêng từng process) hoặc "sqlite" (file trong data/.cache,
+                dùng chung giữa các worker và giữ lại khi restart)
+            history_token_budget: Số token tối đa của lịch sử chat gửi kèm mỗi lần gọi Gemini
+            llm_timeout: Thời gian chờ Gemini tối đa cho một tin nhắn (giây), quá hạn thì
+                trả lời bằng câu trả lời mẫu khớp nhất
+            llm_concurrency: Số lời gọi Gemini đồng thời tối đa
+            llm_hedge_percentile: Gửi thêm một lời gọi khi Gemini chậm hơn percentile này (None để tắt)
+            llm_rpm, llm_tpm: Quota Gemini (request / token mỗi phút); hết quota thì trả lời
+                bằng câu trả lời mẫu khớp nhất thay vì gọi Gemini
+            llm_user_rpm: Số lời gọi Gemini mỗi phút cho một khách
+            llm_quota_wait: Thời gian tối đa chờ quota nạp lại (giây)
         """
         self.api_key = api_key
         self.data_folder = data_folder
         self.knowledge_base = []
-        self.conversation_history = {}  # Lưu lịch sử chat theo user_id
+        self.match_index = None  # Chỉ mục tìm kiếm, build lại mỗi lần load dữ liệu
+        self.search_index = None  # Chỉ mục dùng để tìm (match_index hoặc semantic index)
+        self.segments = {}  # Tên file -> KnowledgeSegment (entry + chỉ mục của file đó)
+        self.cache_folder = os.path.join(data_folder, '.cache')
+        self._load_lock = threading.Lock()
+        self.matcher = matcher
+        if matcher == 'semantic' and not semantic_available():
+            print("⚠️ Semantic matcher cần numpy - dùng fuzzy matcher")
+            self.matcher = 'fuzzy'
+        self.data_version = 0  # Tăng mỗi lần knowledge base thay đổi
+        self.context = ""  # Context cho Gemini, render sẵn theo data_version
+        self.context_hash = ""  # Hash nội dung context để biết khi nào context đổi
+        self.context_tokens = 0  # Ước lượng số token của context đầy đủ
+        self.retrieval_k = retrieval_k
+        self.context_token_budget = context_token_budget
+        self.history_token_budget = history_token_budget
+        self.seed_contents = []  # Lượt mở đầu (quy tắc + dữ liệu), render sẵn theo data_version
+        # Lưu lịch sử chat theo user_id (giới hạn số khách, thời gian và dung lượng)
+        if history_backend == 'sqlite':
+            os.makedirs(self.cache_folder, exist_ok=True)
+            self.conversation_history = SQLiteConversationStore(
+                os.path.join(self.cache_folder, 'conversations.db'), history_max_users, history_ttl,
+                max_bytes_per_user=history_max_bytes)
+        else:
+            self.conversation_history = ConversationStore(history_max_users, history_ttl,
+                                                          max_bytes_per_user=history_max_bytes)
+        self.response_cache = ResponseCache(cache_size, cache_ttl)
+        self.direct_answer_threshold = direct_answer_threshold
+        
+        # Thống kê theo đường xử lý: path -> [số lần, tổng thời gian]
+        self.path_stats = {}
+        self._stats_lock = threading.Lock()
         
         # Cấu hình Gemini
         genai.configure(api_key=api_key)
         self.model = genai.GenerativeModel('gemini-1.5-flash')
+        self.llm = LLMClient(llm_timeout, llm_concurrency, llm_hedge_percentile)
+        self.quota = QuotaLimiter(llm_rpm, llm_tpm, llm_user_rpm, llm_quota_wait)
         
         # Từ điển viết tắt tiếng Việt phổ biến
         self.abbreviations = {
@@ -117,56 +215,140 @@ class ChatbotEngine:
             'alo': 'chào',
         }
         
+        self.normalizer = Normalizer(self.abbreviations)
+        
         # Load dữ liệu
         self.load_data()
     
     def expand_abbreviations(self, text: str) -> str:
-        """Mở rộng các từ viết tắt trong tin nhắn"""
-        words = text.lower().split()
-        expanded = []
-        for word in words:
-            # Loại bỏ dấu câu để check
-            clean_word = re.sub(r'[^\w\s]', '', word)
-            if clean_word in self.abbreviations:
-                expanded.append(self.abbreviations[clean_word])
-            else:
-                expanded.append(word)
-        return ' '.join(expanded)
+        """Mở rộng các từ viết tắt trong tin nhắn (trie đã biên dịch + LRU cache)"""
+        return self.normalizer.expand(text)
+    
+    def normalize_message(self, expanded_message: str) -> str:
+        """Chuẩn hóa tin nhắn đã mở rộng (bỏ dấu câu, khoảng trắng thừa) để làm khóa cache"""
+        return ' '.join(re.sub(r'[^\w\s]', ' ', expanded_message).split())
     
     def load_data(self):
-        """Load tất cả file Excel từ thư mục data"""
-        self.knowledge_base = []
+        """
+        Load tất cả file Excel từ thư mục data
+        Chỉ đọc lại những file mới hoặc đã thay đổi (so mtime, kích thước, hash nội dung);
+        file đã bị xóa thì bỏ khỏi knowledge base.
+        """
         data_path = Path(self.data_folder)
         
         if not data_path.exists():
             data_path.mkdir(parents=True)
             print(f"Đã tạo thư mục {self.data_folder}")
-            return
-        
-        for file in data_path.glob("*.xlsx"):
-            try:
-                df = pd.read_excel(file)
-                # Chuẩn hóa tên cột
-                df.columns = [col.lower().strip() for col in df.columns]
-                
-                for _, row in df.iterrows():
-                    entry = {
-                        'source_file': file.name,
-                        'question': str(row.get('câu hỏi', row.get('question', ''))).strip(),
-                        'answer': str(row.get('câu trả lời', row.get('answer', ''))).strip(),
-                        'image': str(row.get('hình ảnh', row.get('image', ''))).strip(),
-                        'keywords': str(row.get('từ khóa', row.get('keywords', ''))).strip(),
-                        'category': str(row.get('danh mục', row.get('category', ''))).strip(),
-                    }
-                    if entry['question'] and entry['question'] != 'nan':
-                        self.knowledge_base.append(entry)
-                        
-                print(f"✅ Đã load {len(df)} dòng từ {file.name}")
-            except Exception as e:
-                print(f"❌ Lỗi khi đọc {file.name}: {e}")
+        
+        with self._load_lock:
+            segments = {}
+            changed = False
+            for file in data_path.glob("*.xlsx"):
+                previous = self.segments.get(file.name)
+                segment = load_segment(file, previous, self.cache_folder)
+                if segment is None:
+                    continue
+                if segment is not previous:
+                    self._index_segment(segment)
+                    changed = True
+                segments[file.name] = segment
+            
+            if changed or segments.keys() != self.segments.keys() or self.match_index is None:
+                self._set_segments(segments)
         
         print(f"📚 Tổng cộng: {len(self.knowledge_base)} câu hỏi-trả lời")
     
+    def reload_file(self, file_name: str) -> int:
+        """Load lại một file (sau khi upload), không đọc các file khác"""
+        path = Path(self.data_folder) / file_name
+        with self._load_lock:
+            previous = self.segments.get(file_name)
+            segment = load_segment(path, previous, self.cache_folder)
+            if segment is not None and segment is not previous:
+                self._index_segment(segment)
+                self._set_segments({**self.segments, file_name: segment})
+        return len(self.knowledge_base)
+    
+    def remove_file(self, file_name: str) -> int:
+        """Bỏ dữ liệu của một file đã bị xóa, không đọc các file khác"""
+        with self._load_lock:
+            if file_name in self.segments:
+                segments = dict(self.segments)
+                del segments[file_name]
+                self._set_segments(segments)
+        return len(self.knowledge_base)
+    
+    def _index_segment(self, segment: KnowledgeSegment):
+        """
+        Build chỉ mục cho dữ liệu của một file
+        Dùng lại chỉ mục trong snapshot nếu snapshot được build với cùng từ điển viết tắt;
+        không thì build mới rồi ghi snapshot để lần khởi động sau (và các worker khác) mmap lại.
+        """
+        index_key = self._index_key()
+        snapshot = segment.snapshot
+        if snapshot is None or snapshot.index_key != index_key:
+            match_index = MatchIndex(segment.entries, self.normalizer.expand_uncached)
+            snapshot = self._save_snapshot(segment, match_index, index_key) if segment.file_name else None
+            if snapshot is None:
+                segment.match_index = match_index
+        if snapshot is not None:
+            # Đọc entry và chỉ mục từ file mmap thay vì giữ bản riêng trong bộ nhớ
+            segment.snapshot = snapshot
+            segment.entries = snapshot.entries
+            segment.match_index = MatchIndex.from_snapshot(snapshot)
+        segment.search_index = segment.match_index
+        if self.matcher == 'semantic':
+            segment.search_index = SemanticIndex(segment.match_index, self.cache_folder)
+    
+    def _index_key(self) -> str:
+        """Khóa của từ điển viết tắt (câu hỏi mở rộng trong chỉ mục phụ thuộc từ điển này)"""
+        data = json.dumps(sorted(self.abbreviations.items()), ensure_ascii=False)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+    
+    def _save_snapshot(self, segment: KnowledgeSegment, match_index: MatchIndex, index_key: str):
+        """Ghi snapshot của một file rồi mở lại bằng mmap (None nếu không ghi được)"""
+        path = snapshot_path(self.cache_folder, segment.file_name)
+        try:
+            write_snapshot(path, segment, match_index, index_key)
+        except OSError as e:
+            print(f"⚠️ Không ghi được snapshot của {segment.file_name}: {e}")
+            return None
+        snapshot = open_snapshot(path)
+        # Worker khác có thể vừa ghi đè snapshot bằng dữ liệu khác
+        if snapshot is None or snapshot.digest != segment.digest or snapshot.index_key != index_key:
+            return None
+        return snapshot
+    
+    def _set_knowledge_base(self, knowledge_base: List[Dict]):
+        """Thay toàn bộ knowledge base bằng danh sách entry có sẵn (không gắn với file)"""
+        segment = KnowledgeSegment('', knowledge_base)
+        self._index_segment(segment)
+        self._set_segments({'': segment})
+    
+    def _set_segments(self, segments: Dict[str, KnowledgeSegment]):
+        """Ghép chỉ mục các file rồi thay knowledge base (request đang chạy vẫn thấy bản cũ đầy đủ)"""
+        version = self.data_version + 1
+        ordered = [segments[name] for name in sorted(segments)]
+        match_index = SegmentedIndex([seg.match_index for seg in ordered], version)
+        search_index = match_index
+        if self.matcher == 'semantic':
+            search_index = SegmentedIndex([seg.search_index for seg in ordered], version)
+            prune_cache(self.cache_folder, {seg.search_index.digest for seg in ordered})
+        prune_snapshots(self.cache_folder, self.data_folder)
+        knowledge_base = match_index.entries
+        context = self.build_context(knowledge_base)
+        self.context_hash = hashlib.sha256(context.encode('utf-8')).hexdigest()[:16]
+        self.context_tokens = estimate_tokens(context)
+        self.context = context
+        self.seed_contents = self.build_seed_contents(context, self.context_tokens)
+        self.segments = segments
+        self.knowledge_base = knowledge_base
+        self.match_index = match_index
+        self.search_index = search_index
+        self.data_version = version
+        # Câu trả lời cũ dựa trên dữ liệu cũ
+        self.response_cache.clear()
+    
     def reload_data(self):
         """Reload dữ liệu (khi cập nhật file Excel)"""
         self.load_data()
@@ -175,64 +357,147 @@ class ChatbotEngine:
     def find_best_match(self, user_message: str) -> Optional[Dict]:
         """
         Tìm câu trả lời phù hợp nhất từ knowledge base
-        Sử dụng fuzzy matching
+        Sử dụng fuzzy matching trên chỉ mục đã build sẵn
         """
-        if not self.knowledge_base:
-            return None
-        
         # Mở rộng viết tắt
         expanded_message = self.expand_abbreviations(user_message)
         
-        best_match = None
-        best_score = 0
-        
-        for entry in self.knowledge_base:
-            question = entry['question'].lower()
-            expanded_question = self.expand_abbreviations(question)
-            
-            # So sánh với cả tin nhắn gốc và tin nhắn đã mở rộng
-            score1 = difflib.SequenceMatcher(None, user_message.lower(), question).ratio()
-            score2 = difflib.SequenceMatcher(None, expanded_message, expanded_question).ratio()
-            
-            # Kiểm tra từ khóa
-            keywords = entry.get('keywords', '').lower().split(',')
-            keyword_match = any(kw.strip() in expanded_message for kw in keywords if kw.strip())
-            
-            # Tính điểm tổng hợp
-            score = max(score1, score2)
-            if keyword_match:
-                score += 0.3  # Bonus nếu match từ khóa
-            
-            if score > best_score:
-                best_score = score
-                best_match = entry
+        search_index, best_index, _ = self._match(user_message, expanded_message)
+        if best_index is None:
+            return None
+        return search_index.entries[best_index]
+    
+    def _match(self, user_message: str, expanded_message: str):
+        """
+        Tìm entry khớp nhất trên chỉ mục hiện tại
         
-        # Chỉ trả về nếu độ tương đồng đủ cao
-        if best_score >= 0.5:
-            return best_match
-        return None
+        Returns:
+            Tuple[chỉ mục đã dùng, Optional[int], float]: (chỉ mục, vị trí entry hoặc None, điểm)
+        """
+        search_index = self.search_index
+        if not search_index:
+            return search_index, None, 0.0
+        # Fuzzy: chỉ chấm điểm difflib trên các ứng viên lọc từ chỉ mục
+        best_index, score = search_index.best_match(user_message, expanded_message)
+        return search_index, best_index, score
     
-    def build_context(self) -> str:
-        """Xây dựng context từ knowledge base cho Gemini"""
+    def build_context(self, knowledge_base: Optional[List[Dict]] = None,
+                      token_budget: Optional[int] = None) -> str:
+        """
+        Xây dựng context từ knowledge base cho Gemini
+        Context đầy đủ được build một lần mỗi khi load dữ liệu (self.context);
+        khi có token_budget thì dừng thêm entry lúc vượt ngân sách.
+        """
+        if knowledge_base is None:
+            knowledge_base = self.knowledge_base
         context_parts = []
         
         # Nhóm theo category
         categories = {}
-        for entry in self.knowledge_base:
+        for entry in knowledge_base:
             cat = entry.get('category', 'Chung') or 'Chung'
             if cat not in categories:
                 categories[cat] = []
             categories[cat].append(entry)
         
+        tokens = 0
         for cat, entries in categories.items():
             context_parts.append(f"\n=== {cat.upper()} ===")
-            for e in entries[:50]:  # Giới hạn để không quá dài
+            for e in entries:
                 q = e['question']
-                a = e['answer']
-                context_parts.append(f"Hỏi: {q}\nTrả lời: {a}")
+                a = e['answer'] or ''
+                part = f"Hỏi: {q}\nTrả lời: {a}"
+                tokens += estimate_tokens(part)
+                if token_budget is not None and tokens > token_budget:
+                    return "\n".join(context_parts)
+                context_parts.append(part)
         
         return "\n".join(context_parts)
     
+    def retrieve(self, user_message: str, expanded_message: str,
+                 history: Optional[List[Dict]] = None) -> List[Dict]:
+        """
+        Lấy các câu hỏi-trả lời liên quan nhất tới tin nhắn hiện tại
+        và các tin nhắn gần đây của khách (để câu hỏi tiếp nối vẫn có ngữ cảnh)
+        """
+        search_index = self.search_index
+        if not search_index:
+            return []
+        
+        positions = [i for i, _ in search_index.top_k(user_message, expanded_message, self.retrieval_k)]
+        recent = [msg['parts'][0] for msg in (history or []) if msg['role'] == 'user'][-2:]
+        if recent:
+            previous = ' '.join(recent)
+            for i, _ in search_index.top_k(previous, self.expand_abbreviations(previous),
+                                           max(1, self.retrieval_k // 2)):
+                if i not in positions:
+                    positions.append(i)
+        return [search_index.entries[i] for i in positions]
+    
+    def build_prompt_context(self, user_message: str, expanded_message: str,
+                             history: Optional[List[Dict]] = None) -> str:
+        """
+        Dữ liệu gửi kèm tin nhắn hiện tại: rỗng nếu toàn bộ dữ liệu vừa ngân sách token
+        (đã nằm trong lượt mở đầu), không thì chỉ các câu hỏi-trả lời liên quan (top-k)
+        """
+        if self.context_tokens <= self.context_token_budget:
+            return ""
+        entries = self.retrieve(user_message, expanded_message, history)
+        return self.build_context(entries, self.context_token_budget)
+    
+    def build_seed_contents(self, context: str, context_tokens: int) -> List[Dict]:
+        """
+        Lượt mở đầu giống nhau ở mọi lần gọi Gemini: quy tắc + toàn bộ dữ liệu nếu vừa ngân sách token
+        (google-generativeai 0.3.2 chưa có system_instruction nên dùng một cặp lượt user/model)
+        """
+        if context_tokens <= self.context_token_budget:
+            data = f"THÔNG TIN SẢN PHẨM/DỊCH VỤ:\n{context}"
+        else:
+            data = "Thông tin sản phẩm/dịch vụ liên quan được gửi kèm từng tin nhắn của khách."
+        return [
+            {'role': 'user', 'parts': [f"{SYSTEM_RULES}\n{data}"]},
+            {'role': 'model', 'parts': ["Dạ em đã hiểu, em sẵn sàng tư vấn cho khách ạ."]},
+        ]
+    
+    def recent_history(self, history: List[Dict]) -> List[Dict]:
+        """Các lượt hỏi-đáp gần nhất vừa ngân sách token của lịch sử (bỏ từ lượt cũ nhất)"""
+        tokens = 0
+        start = len(history)
+        while start >= 2:
+            turn_tokens = contents_tokens(history[start - 2:start])
+            if tokens + turn_tokens > self.history_token_budget:
+                break
+            tokens += turn_tokens
+            start -= 2
+        return history[start:]
+    
+    def build_contents(self, user_message: str, expanded_message: str,
+                       history: List[Dict], direct_match: Optional[Dict] = None) -> List[Dict]:
+        """
+        Nội dung gửi Gemini: lượt mở đầu + lịch sử gần đây + tin nhắn mới
+        Lịch sử chỉ gồm tin nhắn và câu trả lời, dữ liệu sản phẩm chỉ gửi kèm tin nhắn mới.
+        """
+        parts = []
+        context = self.build_prompt_context(user_message, expanded_message, history)
+        if context:
+            parts.append(f"THÔNG TIN LIÊN QUAN:{context}")
+        
+        # Thêm câu trả lời trực tiếp nếu tìm thấy
+        if direct_match:
+            parts.append(f"""TÌM THẤY CÂU TRẢ LỜI TRỰC TIẾP:
+Câu hỏi mẫu: {direct_match['question']}
+Câu trả lời mẫu: {direct_match['answer']}
+(Hãy dựa vào câu trả lời mẫu này để trả lời, có thể điều chỉnh cho tự nhiên hơn)""")
+        
+        user_content = f"Khách hàng: {user_message}"
+        if expanded_message != user_message.lower():
+            user_content += f"\n(Hiểu là: {expanded_message})"
+        parts.append(user_content)
+        
+        return self.seed_contents + self.recent_history(history) + [
+            {'role': 'user', 'parts': ["\n\n".join(parts)]}
+        ]
+    
     def get_response(self, user_id: str, user_message: str) -> Tuple[str, Optional[str]]:
         """
         Xử lý tin nhắn và trả về câu trả lời
@@ -244,86 +509,163 @@ class ChatbotEngine:
         Returns:
             Tuple[str, Optional[str]]: (câu trả lời, đường dẫn hình ảnh nếu có)
         """
+        result = self.respond(user_id, user_message)
+        return result['answer'], result['image']
+    
+    def respond(self, user_id: str, user_message: str) -> Dict:
+        """
+        Giống get_response nhưng trả về thêm đường xử lý và thời gian
+        
+        Returns:
+            Dict: answer, image, path ('direct' | 'cache' | 'llm' | 'limited' | 'fallback' | 'error'), latency_ms
+        """
+        start = time.monotonic()
+        answer, image, path = self._respond(user_id, user_message)
+        return self._result(answer, image, path, time.monotonic() - start)
+    
+    async def respond_async(self, user_id: str, user_message: str) -> Dict:
+        """Giống respond nhưng dùng trong event loop (chế độ ASGI): chờ quota và Gemini không chặn loop"""
+        start = time.monotonic()
+        answer, image, path = await self._respond_async(user_id, user_message)
+        return self._result(answer, image, path, time.monotonic() - start)
+    
+    def _result(self, answer: str, image: Optional[str], path: str, latency: float) -> Dict:
+        with self._stats_lock:
+            stats = self.path_stats.setdefault(path, [0, 0.0])
+            stats[0] += 1
+            stats[1] += latency
+        return {'answer': answer, 'image': image, 'path': path, 'latency_ms': round(latency * 1000, 1)}
+    
+    def _respond(self, user_id: str, user_message: str) -> Tuple[str, Optional[str], str]:
+        result, pending = self._prepare(user_id, user_message)
+        if result is not None:
+            return result
+        
+        # Hết quota Gemini (hoặc khách nhắn quá nhiều): trả lời bằng dữ liệu có sẵn
+        if self.quota.acquire(user_id, pending['prompt_tokens']) is not None:
+            return self._limited(pending)
+        
+        try:
+            # Gọi Gemini API (có deadline, giới hạn đồng thời và hedging khi còn quota)
+            answer = self.llm.generate(self.model, pending['contents'], self._hedge_allowed(pending))
+        except Exception as e:
+            return self._fallback(pending, e)
+        return self._complete(pending, answer)
+    
+    async def _respond_async(self, user_id: str, user_message: str) -> Tuple[str, Optional[str], str]:
+        # So khớp knowledge base tốn CPU: chạy trong thread để không chặn event loop
+        loop = asyncio.get_running_loop()
+        result, pending = await loop.run_in_executor(None, self._prepare, user_id, user_message)
+        if result is not None:
+            return result
+        
+        # _limited / _complete ghi lịch sử chat (SQLite): cũng chạy trong thread
+        if await self.quota.acquire_async(user_id, pending['prompt_tokens']) is not None:
+            return await loop.run_in_executor(None, self._limited, pending)
+        
+        try:
+            answer = await self.llm.generate_async(self.model, pending['contents'], self._hedge_allowed(pending))
+        except Exception as e:
+            return self._fallback(pending, e)
+        return await loop.run_in_executor(None, self._complete, pending, answer)
+    
+    def _prepare(self, user_id: str, user_message: str) -> Tuple[Optional[Tuple[str, Optional[str], str]],
+                                                                  Optional[Dict]]:
+        """
+        Phần trả lời không cần Gemini
+        
+        Returns:
+            (câu trả lời, None) nếu trả lời được ngay (direct / cache),
+            không thì (None, thông tin để gọi Gemini)
+        """
         # Mở rộng viết tắt
         expanded_message = self.expand_abbreviations(user_message)
         
         # Tìm trong knowledge base trước
-        direct_match = self.find_best_match(user_message)
+        search_index, match_position, score = self._match(user_message, expanded_message)
+        direct_match = search_index.entries[match_position] if match_position is not None else None
+        
+        # Khớp rất chắc chắn: trả lời thẳng câu trả lời mẫu, không cần Gemini
+        if (direct_match and direct_match['answer'] and self.direct_answer_threshold is not None
+                and score >= self.direct_answer_threshold):
+            self._remember(user_id, user_message, direct_match['answer'])
+            return (direct_match['answer'], self._entry_image(direct_match), 'direct'), None
         
         # Lấy lịch sử chat
-        if user_id not in self.conversation_history:
-            self.conversation_history[user_id] = []
-        history = self.conversation_history[user_id]
+        history = self.conversation_history.get(user_id)
         
-        # Xây dựng prompt cho Gemini
-        system_prompt = f"""Bạn là nhân viên tư vấn bán hàng chuyên nghiệp, thân thiện.
-Nhiệm vụ: Trả lời câu hỏi của khách hàng dựa trên thông tin sản phẩm/dịch vụ được cung cấp.
-
-QUY TẮC QUAN TRỌNG:
-1. Trả lời ngắn gọn, thân thiện, dùng emoji phù hợp
-2. Xưng hô: "em" (nhân viên) - "anh/chị" hoặc "mình" (khách hàng)
-3. Nếu không có thông tin, nói "Em sẽ kiểm tra và phản hồi anh/chị sau ạ"
-4. Nếu khách hỏi giá, luôn trả lời cụ thể nếu có trong dữ liệu
-5. Cuối câu thường thêm "ạ" hoặc "nha" để thân thiện
-6. KHÔNG bịa thông tin không có trong dữ liệu
-
-THÔNG TIN SẢN PHẨM/DỊCH VỤ:
-{self.build_context()}
-"""
-
-        # Thêm câu trả lời trực tiếp nếu tìm thấy
-        if direct_match:
-            system_prompt += f"""
-
-TÌM THẤY CÂU TRẢ LỜI TRỰC TIẾP:
-Câu hỏi mẫu: {direct_match['question']}
-Câu trả lời mẫu: {direct_match['answer']}
-(Hãy dựa vào câu trả lời mẫu này để trả lời, có thể điều chỉnh cho tự nhiên hơn)
-"""
-
-        # Xây dựng messages
-        messages = []
+        # Câu hỏi lặp lại: dùng câu trả lời đã cache
+        # (bỏ qua cache nếu đang hội thoại: câu trả lời dựa trên lịch sử của khách này, không dùng cho khách khác)
+        cache_key = None
+        if history:
+            self.response_cache.bypass()
+        else:
+            cache_key = (self.normalize_message(expanded_message), match_position, search_index.version)
+            cached = self.response_cache.get(cache_key)
+            if cached is not None:
+                answer, image_path = cached
+                self._remember(user_id, user_message, answer)
+                return (answer, image_path, 'cache'), None
         
-        # Thêm lịch sử (giới hạn 10 tin nhắn gần nhất)
-        for msg in history[-10:]:
-            messages.append(msg)
+        # Nội dung gửi Gemini: lượt mở đầu cố định + lịch sử gần đây + tin nhắn mới
+        contents = self.build_contents(user_message, expanded_message, history, direct_match)
+        return None, {
+            'user_id': user_id,
+            'user_message': user_message,
+            'direct_match': direct_match,
+            'cache_key': cache_key,
+            'contents': contents,
+            'prompt_tokens': contents_tokens(contents),
+        }
+    
+    def _hedge_allowed(self, pending: Dict):
+        """Chỉ gửi lời gọi hedge khi còn quota (không chờ)"""
+        return lambda: self.quota.acquire(None, pending['prompt_tokens'], max_wait=0) is None
+    
+    def _limited(self, pending: Dict) -> Tuple[str, Optional[str], str]:
+        direct_match = pending['direct_match']
+        if direct_match and direct_match['answer']:
+            self._remember(pending['user_id'], pending['user_message'], direct_match['answer'])
+            return direct_match['answer'], self._entry_image(direct_match), 'limited'
+        return ("Dạ hiện em đang nhận nhiều tin nhắn, anh/chị chờ em một chút rồi nhắn lại giúp em nha 🙏",
+                None, 'limited')
+    
+    def _complete(self, pending: Dict, answer: str) -> Tuple[str, Optional[str], str]:
+        self.quota.record_output(estimate_tokens(answer))
         
-        # Thêm tin nhắn hiện tại
-        user_content = f"Khách hàng: {user_message}"
-        if expanded_message != user_message.lower():
-            user_content += f"\n(Hiểu là: {expanded_message})"
+        # Lưu lịch sử
+        self._remember(pending['user_id'], pending['user_message'], answer)
         
-        try:
-            # Gọi Gemini API
-            chat = self.model.start_chat(history=[])
-            full_prompt = f"{system_prompt}\n\n{user_content}\n\nTrả lời:"
-            
-            response = chat.send_message(full_prompt)
-            answer = response.text.strip()
-            
-            # Lưu lịch sử
-            history.append({'role': 'user', 'parts': [user_message]})
-            history.append({'role': 'model', 'parts': [answer]})
-            
-            # Giới hạn lịch sử
-            if len(history) > 20:
-                self.conversation_history[user_id] = history[-20:]
-            
-            # Trả về kèm hình ảnh nếu có
-            image_path = None
-            if direct_match and direct_match.get('image') and direct_match['image'] != 'nan':
-                image_path = direct_match['image']
-            
-            return answer, image_path
-            
-        except Exception as e:
-            print(f"Lỗi Gemini API: {e}")
-            
-            # Fallback: dùng câu trả lời trực tiếp nếu có
-            if direct_match:
-                return direct_match['answer'], direct_match.get('image')
-            
-            return "Xin lỗi anh/chị, em đang gặp sự cố kỹ thuật. Anh/chị vui lòng thử lại sau ạ! 🙏", None
+        # Trả về kèm hình ảnh nếu có
+        direct_match = pending['direct_match']
+        image_path = self._entry_image(direct_match) if direct_match else None
+        
+        if pending['cache_key'] is not None:
+            self.response_cache.set(pending['cache_key'], (answer, image_path))
+        return answer, image_path, 'llm'
+    
+    def _fallback(self, pending: Dict, error: Exception) -> Tuple[str, Optional[str], str]:
+        print(f"Lỗi Gemini API: {error}")
+        
+        # Fallback: dùng câu trả lời trực tiếp nếu có
+        direct_match = pending['direct_match']
+        if direct_match and direct_match['answer']:
+            return direct_match['answer'], self._entry_image(direct_match), 'fallback'
+        
+        return "Xin lỗi anh/chị, em đang gặp sự cố kỹ thuật. Anh/chị vui lòng thử lại sau ạ! 🙏", None, 'error'
+    
+    @staticmethod
+    def _entry_image(entry: Dict) -> Optional[str]:
+        """Đường dẫn hình ảnh của entry (None nếu ô trống)"""
+        return entry.get('image') or None
+    
+    def _remember(self, user_id: str, user_message: str, answer: str):
+        """Lưu một lượt hỏi-đáp vào lịch sử chat (store tự giới hạn 20 tin nhắn mỗi khách)"""
+        self.conversation_history.append(user_id, user_message, answer)
+    
+    def use_event_loop(self, loop: asyncio.AbstractEventLoop):
+        """Gọi Gemini trên event loop đang chạy (chế độ ASGI) thay vì loop nền riêng"""
+        self.llm.bind_loop(loop)
     
     def update_api_key(self, new_api_key: str):
         """Cập nhật API key mới"""
@@ -335,6 +677,13 @@ Câu trả lời mẫu: {direct_match['answer']}
     def add_abbreviation(self, abbr: str, full: str):
         """Thêm từ viết tắt mới"""
         self.abbreviations[abbr.lower()] = full.lower()
+        # Biên dịch lại rồi thay cả bộ (request đang chạy vẫn dùng bộ cũ đầy đủ)
+        self.normalizer = Normalizer(self.abbreviations)
+        # Câu hỏi đã mở rộng trong chỉ mục phụ thuộc từ điển viết tắt
+        with self._load_lock:
+            for segment in self.segments.values():
+                self._index_segment(segment)
+            self._set_segments(self.segments)
     
     def get_stats(self) -> Dict:
         """Lấy thống kê"""
@@ -342,7 +691,26 @@ Câu trả lời mẫu: {direct_match['answer']}
             'total_qa': len(self.knowledge_base),
             'total_conversations': len(self.conversation_history),
             'total_abbreviations': len(self.abbreviations),
+            'normalizer': self.normalizer.get_stats(),
+            'data_version': self.data_version,
+            'context_hash': self.context_hash,
+            'context_tokens': self.context_tokens,
+            'matcher': self.matcher,
+            'total_files': len(self.segments),
+            'cache': self.response_cache.get_stats(),
+            'conversations': self.conversation_history.get_stats(),
+            'response_paths': self.get_path_stats(),
+            'llm': self.llm.get_stats(),
+            'quota': self.quota.get_stats(),
         }
+    
+    def get_path_stats(self) -> Dict:
+        """Số câu trả lời và thời gian trung bình theo từng đường xử lý"""
+        with self._stats_lock:
+            return {
+                path: {'count': count, 'avg_ms': round(total / count * 1000, 1)}
+                for path, (count, total) in self.path_stats.items()
+            }
 
 
 # Test
@@ -0,0 +1,336 @@
+"""
+Lưu lịch sử hội thoại theo khách hàng
+Giới hạn số khách (LRU), tự quên khách im lặng quá lâu (TTL) và giới hạn
+số tin nhắn / số byte của mỗi khách, để bộ nhớ không tăng dần theo thời gian.
+
+Hai backend cùng giao diện (get / append / clear / get_stats):
+    ConversationStore: trong bộ nhớ của process
+    SQLiteConversationStore: file SQLite dùng chung giữa các worker gunicorn, giữ qua khi restart
+"""
+
+import atexit
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+
+def _message_bytes(message: Dict) -> int:
+    return sum(len(part.encode('utf-8')) for part in message['parts'])
+
+
+def _turn(user_message: str, answer: str) -> List[Dict]:
+    return [{'role': 'user', 'parts': [user_message]}, {'role': 'model', 'parts': [answer]}]
+
+
+def trim_history(history: List[Dict], max_messages: int, max_bytes: int) -> Tuple[int, int]:
+    """
+    Bỏ tin nhắn cũ theo từng lượt cho tới khi vừa giới hạn (luôn giữ lượt mới nhất)
+
+    Returns:
+        Tuple[int, int]: (số tin nhắn đã bỏ, tổng byte còn lại)
+    """
+    size = sum(map(_message_bytes, history))
+    removed = 0
+    while len(history) > 2 and (len(history) > max_messages or size > max_bytes):
+        size -= _message_bytes(history[0]) + _message_bytes(history[1])
+        del history[:2]
+        removed += 2
+    return removed, size
+
+
+class ConversationStore:
+    def __init__(self, max_users: int = 10000, ttl: float = 86400,
+                 max_messages: int = 20, max_bytes_per_user: int = 16384):
+        """
+        Args:
+            max_users: Số khách tối đa giữ lịch sử (bỏ khách lâu không nhắn nhất khi đầy)
+            ttl: Khách không nhắn quá thời gian này (giây) thì bỏ lịch sử
+            max_messages: Số tin nhắn tối đa của mỗi khách (cả khách và bot)
+            max_bytes_per_user: Tổng số byte tối đa của lịch sử một khách
+        """
+        self.max_users = max_users
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.max_bytes_per_user = max_bytes_per_user
+        # user_id -> [lần nhắn cuối, danh sách tin nhắn, tổng số byte]; đầu là khách lâu nhất
+        self._users: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+
+        self.evicted = 0  # Khách bị bỏ vì vượt max_users
+        self.expired = 0  # Khách bị bỏ vì quá ttl
+        self.trimmed = 0  # Tin nhắn cũ bị bỏ vì vượt giới hạn của một khách
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def get(self, user_id: str) -> List[Dict]:
+        """Lịch sử của khách (bản sao, cũ trước mới sau), rỗng nếu chưa có hoặc đã hết hạn"""
+        with self._lock:
+            self._expire(time.monotonic())
+            item = self._users.get(user_id)
+            return list(item[1]) if item is not None else []
+
+    def append(self, user_id: str, user_message: str, answer: str):
+        """Lưu một lượt hỏi-đáp"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            item = self._users.get(user_id)
+            if item is None:
+                item = self._users[user_id] = [now, [], 0]
+            else:
+                self._users.move_to_end(user_id)
+                item[0] = now
+            item[1].extend(_turn(user_message, answer))
+            removed, size = trim_history(item[1], self.max_messages, self.max_bytes_per_user)
+            self.total_bytes += size - item[2]
+            item[2] = size
+            self.trimmed += removed
+
+            while len(self._users) > self.max_users:
+                self._drop_oldest()
+                self.evicted += 1
+
+    def _expire(self, now: float):
+        """Bỏ các khách quá ttl (khách lâu nhất nằm đầu OrderedDict nên dừng ở khách còn hạn)"""
+        while self._users:
+            last_seen = next(iter(self._users.values()))[0]
+            if now - last_seen < self.ttl:
+                break
+            self._drop_oldest()
+            self.expired += 1
+
+    def _drop_oldest(self):
+        _, item = self._users.popitem(last=False)
+        self.total_bytes -= item[2]
+
+    def clear(self):
+        with self._lock:
+            self._users.clear()
+            self.total_bytes = 0
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê lịch sử hội thoại"""
+        with self._lock:
+            self._expire(time.monotonic())
+            return {
+                'backend': 'memory',
+                'users': len(self._users),
+                'messages': sum(len(item[1]) for item in self._users.values()),
+                'bytes': self.total_bytes,
+                'evicted': self.evicted,
+                'expired': self.expired,
+                'trimmed_messages': self.trimmed,
+            }
+
+
+class SQLiteConversationStore:
+    """
+    Lịch sử hội thoại lưu trong SQLite (WAL), các worker cùng đọc/ghi một file
+
+    Ghi theo lô: các lượt mới được gom lại và ghi trong một transaction mỗi flush_interval.
+    Đọc qua cache trong process: một truy vấn theo khóa chính chỉ trả lịch sử khi
+    bản trong DB mới hơn bản trong cache (worker khác vừa trả lời khách này).
+    """
+
+    MAINTENANCE_INTERVAL = 60  # Giây giữa hai lần dọn khách hết hạn / vượt max_users
+
+    def __init__(self, path: str, max_users: int = 10000, ttl: float = 86400,
+                 max_messages: int = 20, max_bytes_per_user: int = 16384,
+                 cache_users: int = 1000, flush_interval: float = 0.2):
+        """
+        Args:
+            path: File SQLite
+            max_users, ttl, max_messages, max_bytes_per_user: Như ConversationStore
+            cache_users: Số khách giữ trong cache của process
+            flush_interval: Thời gian gom các lượt mới trước khi ghi xuống DB (giây)
+        """
+        self.path = path
+        self.max_users = max_users
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.max_bytes_per_user = max_bytes_per_user
+        self.cache_users = cache_users
+        self.flush_interval = flush_interval
+
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS conversations ("
+                             "user_id TEXT PRIMARY KEY, updated REAL NOT NULL, history TEXT NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS conversations_updated ON conversations(updated)")
+        self._db_lock = threading.Lock()
+
+        self._cache: OrderedDict = OrderedDict()  # user_id -> (thời điểm cập nhật, lịch sử)
+        self._pending: Dict[str, Tuple[float, List[Dict]]] = {}  # Các lượt chưa ghi xuống DB
+        self._lock = threading.Lock()
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.batches = 0
+        self.written = 0
+        self.expired = 0
+        self.evicted = 0
+        self.trimmed = 0
+        # Số khách và dung lượng trong DB, thread ghi đếm lại mỗi lần dọn (không quét bảng khi xem thống kê)
+        self.stored_users = 0
+        self.stored_bytes = 0
+
+        self._closed = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, name='conversation-writer', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def __len__(self) -> int:
+        return self.stored_users
+
+    def get(self, user_id: str) -> List[Dict]:
+        """Lịch sử của khách (bản sao, cũ trước mới sau), rỗng nếu chưa có hoặc đã hết hạn"""
+        now = time.time()
+        with self._lock:
+            item = self._pending.get(user_id) or self._cache.get(user_id)
+        cached_updated = item[0] if item is not None else -1.0
+
+        with self._db_lock:
+            # Chỉ đọc lịch sử khi bản trong DB mới hơn bản đang có
+            row = self._db.execute(
+                "SELECT updated, CASE WHEN updated > ? THEN history END FROM conversations WHERE user_id = ?",
+                (cached_updated, user_id)).fetchone()
+        if row is not None and row[1] is not None:
+            item = (row[0], json.loads(row[1]))
+            with self._lock:
+                self.cache_misses += 1
+                self._remember(user_id, item)
+        elif row is None:
+            with self._lock:
+                item = self._pending.get(user_id)
+                if item is None:
+                    # Đã bị xóa khỏi DB (hết hạn, vượt max_users, worker khác clear): bỏ bản trong cache
+                    self._cache.pop(user_id, None)
+        elif item is not None:
+            with self._lock:
+                self.cache_hits += 1
+                if user_id in self._cache:
+                    self._cache.move_to_end(user_id)
+
+        if item is None or now - item[0] >= self.ttl:
+            return []
+        return list(item[1])
+
+    def append(self, user_id: str, user_message: str, answer: str):
+        """Lưu một lượt hỏi-đáp (ghi xuống DB ở lần flush kế tiếp)"""
+        history = self.get(user_id) + _turn(user_message, answer)
+        removed, _ = trim_history(history, self.max_messages, self.max_bytes_per_user)
+        item = (time.time(), history)
+        with self._lock:
+            self.trimmed += removed
+            self._pending[user_id] = item
+            self._remember(user_id, item)
+
+    def _remember(self, user_id: str, item: Tuple[float, List[Dict]]):
+        """Cập nhật cache trong process (gọi khi đang giữ self._lock)"""
+        current = self._cache.get(user_id)
+        if current is not None and current[0] > item[0]:
+            return
+        self._cache[user_id] = item
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_users:
+            self._cache.popitem(last=False)
+
+    def flush(self):
+        """Ghi các lượt đang chờ xuống DB trong một transaction"""
+        with self._lock:
+            batch = dict(self._pending)
+        if not batch:
+            return
+        rows = [(user_id, updated, json.dumps(history, ensure_ascii=False))
+                for user_id, (updated, history) in batch.items()]
+        try:
+            with self._db_lock, self._db:
+                # Không ghi đè bản mới hơn do worker khác ghi
+                self._db.executemany(
+                    "INSERT INTO conversations (user_id, updated, history) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET updated = excluded.updated, history = excluded.history "
+                    "WHERE excluded.updated > conversations.updated", rows)
+        except sqlite3.Error as e:
+            print(f"⚠️ Lỗi khi ghi lịch sử hội thoại: {e}")
+            return
+        with self._lock:
+            for user_id, item in batch.items():
+                if self._pending.get(user_id) is item:
+                    del self._pending[user_id]
+            self.batches += 1
+            self.written += len(rows)
+
+    def _maintain(self):
+        """Xóa khách hết hạn và khách cũ nhất khi vượt max_users"""
+        try:
+            with self._db_lock, self._db:
+                expired = self._db.execute("DELETE FROM conversations WHERE updated < ?",
+                                           (time.time() - self.ttl,)).rowcount
+                evicted = self._db.execute(
+                    "DELETE FROM conversations WHERE updated < "
+                    "(SELECT updated FROM conversations ORDER BY updated DESC LIMIT 1 OFFSET ?)",
+                    (self.max_users - 1,)).rowcount
+                users, size = self._db.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(history AS BLOB))), 0) FROM conversations").fetchone()
+        except sqlite3.Error as e:
+            print(f"⚠️ Lỗi khi dọn lịch sử hội thoại: {e}")
+            return
+        with self._lock:
+            self.expired += expired
+            self.evicted += evicted
+            self.stored_users = users
+            self.stored_bytes = size
+
+    def _write_loop(self):
+        next_maintenance = time.monotonic()
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+            if time.monotonic() >= next_maintenance:
+                self._maintain()
+                next_maintenance = time.monotonic() + self.MAINTENANCE_INTERVAL
+
+    def close(self):
+        """Ghi nốt các lượt đang chờ rồi đóng DB"""
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._writer.join()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._cache.clear()
+            self.stored_users = 0
+            self.stored_bytes = 0
+        with self._db_lock, self._db:
+            self._db.execute("DELETE FROM conversations")
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê lịch sử hội thoại (users/bytes đếm ở lần dọn gần nhất, trễ tối đa MAINTENANCE_INTERVAL)"""
+        with self._lock:
+            lookups = self.cache_hits + self.cache_misses
+            return {
+                'backend': 'sqlite',
+                'users': self.stored_users,
+                'bytes': self.stored_bytes,
+                'cached_users': len(self._cache),
+                'pending': len(self._pending),
+                'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses,
+                'cache_hit_rate': round(self.cache_hits / lookups, 3) if lookups else 0.0,
+                'batches': self.batches,
+                'written': self.written,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'trimmed_messages': self.trimmed,
+            }
@@ -0,0 +1,134 @@
+"""
+Chỉ mục mid tin nhắn đã xử lý
+Facebook gửi lại webhook khi server trả lời chậm; tin nhắn có mid đã trả lời trong
+khoảng `window` bị bỏ qua trước khi vào hàng đợi / engine. Lưu trên SQLite để các
+worker gunicorn dùng chung, kèm cache trong process cho mid mới xử lý gần đây.
+"""
+
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List
+
+
+class DedupeIndex:
+    MAINTENANCE_INTERVAL = 60  # Dọn mid hết hạn mỗi 60 giây
+
+    def __init__(self, path: str, window: float = 86400, max_entries: int = 200000,
+                 cache_size: int = 10000):
+        """
+        Args:
+            path: File SQLite (có thể dùng chung file với hàng đợi webhook)
+            window: Nhớ mid đã xử lý trong bao lâu (giây)
+            max_entries: Số mid tối đa lưu trong DB (xóa mid cũ nhất khi vượt)
+            cache_size: Số mid giữ trong bộ nhớ process
+        """
+        self.path = path
+        self.window = window
+        self.max_entries = max_entries
+        self.cache_size = cache_size
+
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS handled_mids ("
+                             "mid TEXT PRIMARY KEY, handled REAL NOT NULL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS handled_mids_handled ON handled_mids(handled)")
+        self._db_lock = threading.Lock()
+
+        self._cache: OrderedDict = OrderedDict()  # mid -> thời điểm xử lý
+        self._lock = threading.Lock()
+        self._next_maintenance = time.monotonic()
+
+        self.checked = 0
+        self.cache_hits = 0
+        self.duplicates: Dict[str, int] = {}  # nơi phát hiện -> số tin trùng bị bỏ
+        self.added = 0
+        self.expired = 0
+
+    def filter(self, events: List[Dict], stage: str = 'webhook') -> List[Dict]:
+        """
+        Bỏ các event có mid đã xử lý trong window (event không có mid thì giữ)
+
+        Args:
+            events: [{'mid', ...}]
+            stage: Tên nơi gọi để đếm riêng (VD: 'webhook', 'worker')
+        """
+        cutoff = time.time() - self.window
+        mids = {event['mid'] for event in events if event.get('mid')}
+        handled = set()
+        with self._lock:
+            for mid in mids:
+                seen = self._cache.get(mid)
+                if seen is not None and seen > cutoff:
+                    handled.add(mid)
+            self.cache_hits += len(handled)
+        missing = list(mids - handled)
+        if missing:
+            # mid do worker khác xử lý thì chỉ có trong DB
+            with self._db_lock:
+                rows = self._db.execute(
+                    f"SELECT mid FROM handled_mids WHERE handled > ? AND mid IN ({','.join('?' * len(missing))})",
+                    (cutoff, *missing)).fetchall()
+            handled.update(row[0] for row in rows)
+
+        fresh = [event for event in events if event.get('mid') not in handled]
+        with self._lock:
+            self.checked += len(events)
+            if len(fresh) < len(events):
+                self.duplicates[stage] = self.duplicates.get(stage, 0) + len(events) - len(fresh)
+        return fresh
+
+    def add(self, mids: List[str]):
+        """Ghi nhận các mid đã trả lời xong"""
+        mids = [mid for mid in mids if mid]
+        if not mids:
+            return
+        now = time.time()
+        with self._db_lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO handled_mids (mid, handled) VALUES (?, ?)",
+                                 [(mid, now) for mid in mids])
+        with self._lock:
+            self.added += len(mids)
+            for mid in mids:
+                self._cache[mid] = now
+                self._cache.move_to_end(mid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        if time.monotonic() >= self._next_maintenance:
+            self._maintain()
+
+    def _maintain(self):
+        """Xóa mid quá window và mid cũ nhất khi vượt max_entries"""
+        self._next_maintenance = time.monotonic() + self.MAINTENANCE_INTERVAL
+        try:
+            with self._db_lock, self._db:
+                expired = self._db.execute("DELETE FROM handled_mids WHERE handled < ?",
+                                           (time.time() - self.window,)).rowcount
+                expired += self._db.execute(
+                    "DELETE FROM handled_mids WHERE handled < "
+                    "(SELECT handled FROM handled_mids ORDER BY handled DESC LIMIT 1 OFFSET ?)",
+                    (self.max_entries - 1,)).rowcount
+        except sqlite3.Error as e:
+            print(f"⚠️ Lỗi khi dọn mid đã xử lý: {e}")
+            return
+        with self._lock:
+            self.expired += expired
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê chống trùng tin nhắn"""
+        with self._db_lock:
+            stored = self._db.execute("SELECT COUNT(*) FROM handled_mids").fetchone()[0]
+        with self._lock:
+            return {
+                'stored_mids': stored,
+                'cached_mids': len(self._cache),
+                'checked': self.checked,
+                'cache_hits': self.cache_hits,
+                'duplicates': dict(self.duplicates),
+                'duplicates_total': sum(self.duplicates.values()),
+                'added': self.added,
+                'expired': self.expired,
+            }
@@ -0,0 +1,249 @@
+"""
+Snapshot nhị phân của knowledge base (một file snapshot cho mỗi file Excel)
+Lưu entry, câu hỏi đã chuẩn hóa và dữ liệu chỉ mục dưới dạng mảng uint32 + chuỗi UTF-8.
+Khi khởi động, snapshot được mmap thay vì đọc lại Excel; các worker gunicorn
+mở cùng một file nên dùng chung page cache của hệ điều hành thay vì mỗi worker một bản.
+
+Cấu trúc file:
+    MAGIC (8 byte) | độ dài meta (uint32) | meta JSON | padding tới bội số 8 | các section
+Mỗi section nằm ở vị trí bội số 8; vị trí/độ dài ghi trong meta['sections'].
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+MAGIC = b'KBSNAP\x00\x01'
+FORMAT_VERSION = 2  # Tăng khi đổi cấu trúc file hoặc cách lưu entry
+SUFFIX = '.kbsnap'
+
+ENTRY_FIELDS = ('question', 'answer', 'image', 'keywords', 'category')
+# Cột chuỗi lưu trong snapshot: các trường của entry + câu hỏi đã chuẩn hóa cho chỉ mục
+TEXT_COLUMNS = ENTRY_FIELDS + ('question_lower', 'question_expanded')
+
+
+def snapshot_path(snapshot_dir: str, file_name: str) -> Path:
+    return Path(snapshot_dir) / f"{file_name}{SUFFIX}"
+
+
+def _align(n: int) -> int:
+    return (n + 7) & ~7
+
+
+class StringColumn:
+    """Dãy chuỗi đọc thẳng từ mmap (giải mã khi truy cập)"""
+
+    __slots__ = ('offsets', 'data')
+
+    def __init__(self, offsets: memoryview, data: memoryview):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return str(self.data[self.offsets[i]:self.offsets[i + 1]], 'utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class SnapshotEntry:
+    """
+    Entry của knowledge base đọc từ snapshot (dữ liệu nằm theo cột trong mmap)
+    Cùng cách truy cập với KnowledgeEntry: entry['question'], entry.get('image'); ô trống là None.
+    """
+
+    __slots__ = ('_snapshot', '_index')
+
+    def __init__(self, snapshot: 'Snapshot', index: int):
+        self._snapshot = snapshot
+        self._index = index
+
+    def __getitem__(self, key: str) -> Optional[str]:
+        if key == 'source_file':
+            return self._snapshot.file_name
+        if key not in ENTRY_FIELDS:
+            raise KeyError(key)
+        return self._snapshot.columns[key][self._index] or None
+
+    def get(self, key: str, default=None) -> Optional[str]:
+        if key != 'source_file' and key not in ENTRY_FIELDS:
+            return default
+        return self[key]
+
+    def to_dict(self) -> Dict:
+        return {key: self[key] for key in ('source_file',) + ENTRY_FIELDS}
+
+    def __repr__(self) -> str:
+        return f"SnapshotEntry({self.to_dict()!r})"
+
+
+class Snapshot:
+    """Snapshot đã mmap của một file Excel"""
+
+    def __init__(self, path: Path):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        if bytes(view[:8]) != MAGIC:
+            raise ValueError(f"{path.name} không phải snapshot")
+        meta_len = struct.unpack_from('<I', view, 8)[0]
+        self.meta = json.loads(str(view[12:12 + meta_len], 'utf-8'))
+        if self.meta['format'] != FORMAT_VERSION or self.meta['byteorder'] != sys.byteorder:
+            raise ValueError(f"{path.name}: snapshot khác định dạng")
+        self._base = _align(12 + meta_len)
+        self._view = view
+
+        source = self.meta['source']
+        self.file_name = source['file_name']
+        self.mtime = source['mtime']
+        self.size = source['size']
+        self.digest = source['digest']
+        self.index_key = self.meta['index_key']
+        self.count = self.meta['count']
+
+        self.columns = {
+            name: StringColumn(self.uint32(f"{name}.offsets"), self.section(f"{name}.data"))
+            for name in TEXT_COLUMNS
+        }
+        self.entries = [SnapshotEntry(self, i) for i in range(self.count)]
+
+    def section(self, name: str) -> memoryview:
+        offset, length = self.meta['sections'][name]
+        start = self._base + offset
+        return self._view[start:start + length]
+
+    def uint32(self, name: str) -> memoryview:
+        """Mảng uint32 trỏ thẳng vào mmap (không copy)"""
+        return self.section(name).cast('I')
+
+    def postings(self, name: str, keys: List[str], with_counts: bool = True) -> Dict:
+        """Inverted index: key -> (ids, counts) hoặc key -> ids"""
+        offsets = self.uint32(f"{name}.offsets")
+        ids = self.uint32(f"{name}.ids")
+        counts = self.uint32(f"{name}.counts") if with_counts else None
+        result = {}
+        for i, key in enumerate(keys):
+            start, end = offsets[i], offsets[i + 1]
+            result[key] = (ids[start:end], counts[start:end]) if with_counts else ids[start:end]
+        return result
+
+    def matches(self, stat: os.stat_result) -> bool:
+        return stat.st_mtime == self.mtime and stat.st_size == self.size
+
+
+def open_snapshot(path: Path) -> Optional[Snapshot]:
+    """Mở snapshot, None nếu không có hoặc không đọc được"""
+    if not path.exists():
+        return None
+    try:
+        return Snapshot(path)
+    except (OSError, ValueError, KeyError) as e:
+        print(f"⚠️ Bỏ qua snapshot {path.name}: {e}")
+        return None
+
+
+class _Writer:
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.sections: Dict[str, Tuple[int, int]] = {}
+        self.size = 0
+
+    def add(self, name: str, data: bytes):
+        self.sections[name] = (self.size, len(data))
+        padding = _align(len(data)) - len(data)
+        self.chunks.append(data + b'\0' * padding)
+        self.size += len(data) + padding
+
+    def add_strings(self, name: str, values):
+        offsets = array('I', [0])
+        blob = bytearray()
+        for value in values:
+            blob += value.encode('utf-8')
+            offsets.append(len(blob))
+        self.add(f"{name}.offsets", offsets.tobytes())
+        self.add(f"{name}.data", bytes(blob))
+
+    def add_postings(self, name: str, postings: Dict, with_counts: bool = True) -> List[str]:
+        keys = list(postings)
+        offsets = array('I', [0])
+        ids = array('I')
+        counts = array('I')
+        for key in keys:
+            if with_counts:
+                ids.extend(postings[key][0])
+                counts.extend(postings[key][1])
+            else:
+                ids.extend(postings[key])
+            offsets.append(len(ids))
+        self.add(f"{name}.offsets", offsets.tobytes())
+        self.add(f"{name}.ids", ids.tobytes())
+        if with_counts:
+            self.add(f"{name}.counts", counts.tobytes())
+        return keys
+
+
+def write_snapshot(path: Path, segment, match_index, index_key: str):
+    """
+    Ghi snapshot của một segment (ghi ra file tạm rồi đổi tên, an toàn khi worker khác đang đọc)
+
+    Args:
+        path: Đường dẫn file snapshot
+        segment: KnowledgeSegment (thông tin file nguồn + entry)
+        match_index: MatchIndex đã build cho segment
+        index_key: Khóa của từ điển viết tắt dùng để build chỉ mục
+    """
+    writer = _Writer()
+    entries = segment.entries
+    for field in ENTRY_FIELDS:
+        writer.add_strings(field, (entry[field] or '' for entry in entries))  # None lưu thành chuỗi rỗng
+    writer.add_strings('question_lower', match_index.questions)
+    writer.add_strings('question_expanded', match_index.expanded_questions)
+    writer.add('question_lengths', array('I', match_index.question_lengths).tobytes())
+    writer.add('expanded_lengths', array('I', match_index.expanded_lengths).tobytes())
+    meta = {
+        'format': FORMAT_VERSION,
+        'byteorder': sys.byteorder,
+        'source': {
+            'file_name': segment.file_name,
+            'mtime': segment.mtime,
+            'size': segment.size,
+            'digest': segment.digest,
+        },
+        'index_key': index_key,
+        'count': len(entries),
+        'question_chars': writer.add_postings('question_postings', match_index.question_postings),
+        'expanded_chars': writer.add_postings('expanded_postings', match_index.expanded_postings),
+        'keywords': writer.add_postings('keyword_postings', match_index.keyword_postings, with_counts=False),
+        'sections': writer.sections,
+    }
+    meta_bytes = json.dumps(meta, ensure_ascii=False).encode('utf-8')
+    header = MAGIC + struct.pack('<I', len(meta_bytes)) + meta_bytes
+    header += b'\0' * (_align(len(header)) - len(header))
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        for chunk in writer.chunks:
+            f.write(chunk)
+    os.replace(tmp, path)
+
+
+def prune_snapshots(snapshot_dir: str, data_folder: str):
+    """Xóa snapshot của các file Excel không còn tồn tại (chỉ là dọn dẹp, lỗi thì bỏ qua)"""
+    for path in Path(snapshot_dir).glob(f"*{SUFFIX}"):
+        if not (Path(data_folder) / path.name[:-len(SUFFIX)]).exists():
+            try:
+                # Worker khác khởi động cùng lúc có thể vừa xóa file này
+                path.unlink(missing_ok=True)
+            except OSError as e:
+                print(f"⚠️ Không xóa được snapshot cũ {path.name}: {e}")
@@ -0,0 +1,199 @@
+"""
+Đọc dữ liệu Excel và quản lý knowledge base theo từng file
+Mỗi file là một segment riêng (entry + chỉ mục), nhận biết thay đổi bằng mtime,
+kích thước và hash nội dung để reload chỉ những file đã đổi.
+File Excel được đọc bằng openpyxl ở chế độ read-only, xử lý theo cột, đọc mọi sheet.
+"""
+
+import hashlib
+import os
+import sys
+from itertools import zip_longest
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from openpyxl import load_workbook
+
+from kb_snapshot import open_snapshot, snapshot_path
+
+
+class KnowledgeEntry:
+    """
+    Một câu hỏi-trả lời trong knowledge base
+    Gọn hơn dict (dùng __slots__), tên file/danh mục được intern để các dòng dùng chung một chuỗi,
+    ô trống là None. Truy cập như dict (entry['answer'], entry.get('image')) hoặc thuộc tính.
+    """
+
+    __slots__ = ('source_file', 'question', 'answer', 'image', 'keywords', 'category')
+
+    def __init__(self, source_file: str, question: str, answer: Optional[str] = None,
+                 image: Optional[str] = None, keywords: Optional[str] = None,
+                 category: Optional[str] = None):
+        self.source_file = sys.intern(source_file)
+        self.question = question
+        self.answer = answer
+        self.image = image
+        self.keywords = keywords
+        self.category = sys.intern(category) if category is not None else None
+
+    def __getitem__(self, key: str) -> Optional[str]:
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None) -> Optional[str]:
+        return getattr(self, key) if key in self.__slots__ else default
+
+    def to_dict(self) -> Dict:
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"KnowledgeEntry({self.to_dict()!r})"
+
+
+class KnowledgeSegment:
+    """Dữ liệu và chỉ mục của một file Excel"""
+
+    def __init__(self, file_name: str, entries: List[KnowledgeEntry],
+                 mtime: float = 0.0, size: int = 0, digest: str = ""):
+        self.file_name = file_name
+        self.entries = entries
+        self.mtime = mtime
+        self.size = size
+        self.digest = digest
+        self.match_index = None  # MatchIndex của riêng file này
+        self.search_index = None  # Chỉ mục dùng để tìm (fuzzy hoặc semantic)
+        self.snapshot = None  # Snapshot đã mmap nếu entry được đọc từ snapshot
+
+    def is_unchanged(self, stat: os.stat_result) -> bool:
+        """So nhanh bằng mtime + kích thước, không cần đọc file"""
+        return stat.st_mtime == self.mtime and stat.st_size == self.size
+
+
+def file_digest(path: Path) -> str:
+    """Hash nội dung file (phát hiện file được ghi lại nhưng không đổi nội dung)"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Tên cột (tiếng Việt trước, tiếng Anh dự phòng) của từng trường
+COLUMN_NAMES = {
+    'question': ('câu hỏi', 'question'),
+    'answer': ('câu trả lời', 'answer'),
+    'image': ('hình ảnh', 'image'),
+    'keywords': ('từ khóa', 'keywords'),
+    'category': ('danh mục', 'category'),
+}
+
+
+def resolve_columns(header) -> Dict[str, Optional[int]]:
+    """Vị trí cột của từng trường, xác định một lần cho mỗi sheet"""
+    positions = {}
+    for i, name in enumerate(header):
+        if name is not None:
+            positions.setdefault(str(name).lower().strip(), i)
+    mapping = {}
+    for field, names in COLUMN_NAMES.items():
+        mapping[field] = next((positions[n] for n in names if n in positions), None)
+    return mapping
+
+
+def _column_text(column, size: int) -> List[Optional[str]]:
+    """Chuyển cả cột thành chuỗi (ô trống hoặc không có cột -> None)"""
+    if column is None:
+        return [None] * size
+    return [None if value is None else (str(value).strip() or None) for value in column]
+
+
+def read_sheet_entries(rows, source_file: str) -> Tuple[List[KnowledgeEntry], int]:
+    """
+    Tạo entry từ các dòng của một sheet (dòng đầu là tiêu đề)
+
+    Returns:
+        Tuple[List[KnowledgeEntry], int]: (các entry, số dòng dữ liệu)
+    """
+    header = next(rows, None)
+    if header is None:
+        return [], 0
+    mapping = resolve_columns(header)
+    if mapping['question'] is None:
+        return [], 0  # Sheet không có dữ liệu hỏi-đáp (VD: sheet hướng dẫn)
+
+    # Chuyển dòng -> cột một lần, sau đó xử lý theo từng cột
+    columns = list(zip_longest(*rows))
+    size = len(columns[0]) if columns else 0
+    fields = {
+        field: _column_text(columns[i] if i is not None and i < len(columns) else None, size)
+        for field, i in mapping.items()
+    }
+    entries = [
+        KnowledgeEntry(source_file, question, answer, image, keywords, category)
+        for question, answer, image, keywords, category in zip(
+            fields['question'], fields['answer'], fields['image'], fields['keywords'], fields['category'])
+        if question
+    ]
+    return entries, size
+
+
+def read_excel_entries(path: Path) -> List[KnowledgeEntry]:
+    """Đọc các câu hỏi-trả lời từ tất cả sheet của một file Excel"""
+    workbook = load_workbook(path, read_only=True, data_only=True)
+    try:
+        entries = []
+        total_rows = 0
+        sheets = 0
+        for sheet in workbook.worksheets:
+            sheet_entries, rows = read_sheet_entries(sheet.iter_rows(values_only=True), path.name)
+            if rows:
+                sheets += 1
+                total_rows += rows
+                entries.extend(sheet_entries)
+    finally:
+        workbook.close()
+
+    print(f"✅ Đã load {total_rows} dòng ({sheets} sheet) từ {path.name}")
+    return entries
+
+
+def load_segment(path: Path, previous: Optional[KnowledgeSegment] = None,
+                 snapshot_dir: Optional[str] = None) -> Optional[KnowledgeSegment]:
+    """
+    Load một file thành segment
+
+    Args:
+        path: File Excel
+        previous: Segment đã load trước đó của file này
+        snapshot_dir: Thư mục snapshot; nếu có snapshot khớp file thì mmap snapshot thay vì đọc Excel
+
+    Returns:
+        previous nếu file không đổi (chỉ cập nhật mtime), segment mới nếu file đã đổi.
+        Nếu không đọc được file thì giữ previous (None nếu là file mới).
+    """
+    stat = path.stat()
+    if previous is not None and previous.is_unchanged(stat):
+        return previous
+
+    snapshot = open_snapshot(snapshot_path(snapshot_dir, path.name)) if snapshot_dir else None
+    if snapshot is not None and snapshot.matches(stat):
+        digest = snapshot.digest
+    else:
+        digest = file_digest(path)
+    if previous is not None and previous.digest == digest:
+        previous.mtime, previous.size = stat.st_mtime, stat.st_size
+        return previous
+
+    if snapshot is not None and snapshot.digest == digest:
+        segment = KnowledgeSegment(path.name, snapshot.entries, stat.st_mtime, stat.st_size, snapshot.digest)
+        segment.snapshot = snapshot
+        print(f"⚡ Đã load {snapshot.count} câu hỏi từ snapshot của {path.name}")
+        return segment
+
+    try:
+        entries = read_excel_entries(path)
+    except Exception as e:
+        print(f"❌ Lỗi khi đọc {path.name}: {e}")
+        return previous
+    return KnowledgeSegment(path.name, entries, stat.st_mtime, stat.st_size, digest)
@@ -0,0 +1,204 @@
+"""
+Gọi Gemini không chặn trên một event loop (chạy nền, hoặc loop của server ASGI)
+- Deadline cho mỗi tin nhắn (tính cả thời gian chờ lượt)
+- Semaphore giới hạn số lời gọi đồng thời theo quota
+- Hedging: lời gọi chậm hơn percentile latency gần đây thì gửi thêm một lời gọi, lấy kết quả về trước
+Thread xử lý tin nhắn chỉ chờ kết quả, khi quá deadline thì engine trả lời bằng dữ liệu có sẵn.
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+
+class LLMClient:
+    def __init__(self, timeout: float = 15.0, max_concurrency: int = 4,
+                 hedge_percentile: Optional[float] = 0.95, hedge_min_samples: int = 20,
+                 loop: Optional[asyncio.AbstractEventLoop] = None):
+        """
+        Args:
+            timeout: Thời gian tối đa cho một tin nhắn (giây)
+            max_concurrency: Số lời gọi Gemini đồng thời tối đa
+            hedge_percentile: Gửi thêm lời gọi khi lời gọi đầu chậm hơn percentile này
+                của các lần gần đây (None để tắt hedging)
+            hedge_min_samples: Số lần gọi thành công tối thiểu trước khi bật hedging
+            loop: Event loop đang chạy sẵn để gọi Gemini (VD: loop của server ASGI);
+                None thì tạo loop riêng chạy trong thread nền
+        """
+        self.timeout = timeout
+        self.max_concurrency = max_concurrency
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.latencies = deque(maxlen=200)  # Latency các lời gọi tới model thành công gần đây
+
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.hedged = 0
+        self.hedge_wins = 0  # Lần lời gọi hedge về trước lời gọi đầu
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_concurrency, thread_name_prefix='llm-call')
+        self._owns_loop = loop is None
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=self._run_loop, args=(loop,), name='llm-loop', daemon=True).start()
+        self.loop = loop
+
+    @staticmethod
+    def _run_loop(loop: asyncio.AbstractEventLoop):
+        loop.run_forever()
+        loop.close()
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """
+        Chuyển sang gọi Gemini trên event loop đang chạy (VD: loop của server ASGI)
+        Giữ nguyên thống kê và latency gần đây (hedging không phải học lại); loop nền riêng
+        được dừng sau khi các lời gọi đang chạy trên đó hết hạn.
+        """
+        if loop is self.loop:
+            return
+        old, owned = self.loop, self._owns_loop
+        # Semaphore gắn với loop; lời gọi đang chạy trên loop cũ vẫn trả chỗ cho semaphore cũ
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.loop = loop
+        self._owns_loop = False
+        if owned:
+            # Lời gọi nào cũng kết thúc trong timeout (deadline), sau đó loop cũ không còn việc
+            old.call_soon_threadsafe(old.call_later, self.timeout + 1, old.stop)
+
+    def generate(self, model, contents: List[Dict],
+                 hedge_allowed: Optional[Callable[[], bool]] = None) -> str:
+        """
+        Gọi Gemini từ thread thường, chờ tối đa timeout (TimeoutError nếu quá hạn)
+
+        Args:
+            model: Model Gemini (generate_content_async hoặc generate_content)
+            contents: Các lượt hội thoại gửi đi
+            hedge_allowed: Hỏi trước khi gửi lời gọi hedge (VD: còn quota không)
+        """
+        return self.submit(model, contents, hedge_allowed).result()
+
+    async def generate_async(self, model, contents: List[Dict],
+                             hedge_allowed: Optional[Callable[[], bool]] = None) -> str:
+        """Giống generate nhưng dùng trong coroutine (chạy thẳng nếu đang ở trên self.loop)"""
+        if asyncio.get_running_loop() is self.loop:
+            return await self._generate_with_deadline(model, contents, hedge_allowed)
+        return await asyncio.wrap_future(self.submit(model, contents, hedge_allowed))
+
+    def submit(self, model, contents: List[Dict],
+               hedge_allowed: Optional[Callable[[], bool]] = None) -> concurrent.futures.Future:
+        """Đưa lời gọi lên event loop nền, trả về Future"""
+        return asyncio.run_coroutine_threadsafe(
+            self._generate_with_deadline(model, contents, hedge_allowed), self.loop)
+
+    async def _generate_with_deadline(self, model, contents: List[Dict],
+                                      hedge_allowed: Optional[Callable[[], bool]]) -> str:
+        with self._lock:
+            self.calls += 1
+        try:
+            return await asyncio.wait_for(self._generate(model, contents, hedge_allowed), self.timeout)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(f"Gemini không trả lời sau {self.timeout}s") from None
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+
+    async def _generate(self, model, contents: List[Dict],
+                        hedge_allowed: Optional[Callable[[], bool]] = None) -> str:
+        started = asyncio.Event()
+        first = asyncio.ensure_future(self._call(model, contents, started))
+        tasks = [first]
+        try:
+            delay = self.hedge_delay()
+            if delay is not None:
+                # Tính thời gian từ lúc lời gọi đầu thực sự chạy (không tính lúc chờ semaphore);
+                # chỉ hedge khi còn chỗ trống để hedge không phải xếp hàng sau các lời gọi khác
+                await started.wait()
+                done, _ = await asyncio.wait(tasks, timeout=delay)
+                if (not done and not self._semaphore.locked()
+                        and (hedge_allowed is None or hedge_allowed())):
+                    with self._lock:
+                        self.hedged += 1
+                    tasks.append(asyncio.ensure_future(self._call(model, contents)))
+
+            # Lấy kết quả thành công về trước; chỉ báo lỗi khi mọi lời gọi đều lỗi
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _call(self, model, contents: List[Dict], started: Optional[asyncio.Event] = None) -> str:
+        semaphore = self._semaphore
+        await semaphore.acquire()
+        if started is not None:
+            started.set()
+        with self._lock:
+            self.in_flight += 1
+        start = time.monotonic()
+        release = functools.partial(self._release, semaphore, start)
+        if hasattr(model, 'generate_content_async'):
+            future = asyncio.ensure_future(model.generate_content_async(contents))
+            future.add_done_callback(release)
+            response = await future
+        else:
+            # Model chỉ có hàm đồng bộ (VD: model giả khi test): chạy trong thread riêng.
+            # Thread không dừng được khi bị hủy nên lời gọi vẫn giữ chỗ trong semaphore tới khi xong.
+            future = asyncio.get_running_loop().run_in_executor(self._executor, model.generate_content, contents)
+            future.add_done_callback(release)
+            response = await asyncio.shield(future)
+        return response.text.strip()
+
+    def _release(self, semaphore: asyncio.Semaphore, start: float, future: asyncio.Future):
+        """Lời gọi tới model đã xong (kể cả lời gọi đã bị bỏ vì hedge/deadline)"""
+        semaphore.release()
+        with self._lock:
+            self.in_flight -= 1
+            # Ghi cả latency của lời gọi bị bỏ, nếu không percentile sẽ thấp dần và hedge ngày càng nhiều
+            if not future.cancelled() and future.exception() is None:
+                self.latencies.append(time.monotonic() - start)
+
+    def hedge_delay(self) -> Optional[float]:
+        """Thời gian chờ trước khi gửi lời gọi hedge (None nếu chưa đủ dữ liệu hoặc đã tắt)"""
+        if self.hedge_percentile is None:
+            return None
+        with self._lock:
+            if len(self.latencies) < self.hedge_min_samples:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * self.hedge_percentile))]
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê lời gọi Gemini"""
+        with self._lock:
+            ordered = sorted(self.latencies)
+            return {
+                'calls': self.calls,
+                'in_flight': self.in_flight,
+                'timeouts': self.timeouts,
+                'errors': self.errors,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'avg_ms': round(sum(ordered) / len(ordered) * 1000, 1) if ordered else 0.0,
+                'p95_ms': round(ordered[int(len(ordered) * 0.95)] * 1000, 1) if ordered else 0.0,
+            }
@@ -0,0 +1,239 @@
+"""
+Chỉ mục tìm kiếm cho knowledge base
+Chuẩn hóa câu hỏi một lần khi load dữ liệu, lọc ứng viên bằng inverted index
+trước khi chạy difflib (tốn kém) trên danh sách rút gọn.
+"""
+
+import difflib
+import heapq
+from array import array
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+KEYWORD_BONUS = 0.3  # Điểm cộng khi tin nhắn chứa từ khóa
+MIN_MATCH_SCORE = 0.5  # Ngưỡng tối thiểu để coi là khớp
+MIN_RETRIEVAL_SCORE = 0.2  # Ngưỡng tối thiểu để đưa entry vào context cho Gemini
+
+
+def _char_postings(texts: List[str]) -> Dict[str, Tuple[array, array]]:
+    """Inverted index ký tự -> (danh sách entry, số lần xuất hiện)"""
+    postings: Dict[str, Tuple[array, array]] = {}
+    for i, text in enumerate(texts):
+        for ch, count in Counter(text).items():
+            posting = postings.get(ch)
+            if posting is None:
+                posting = postings[ch] = (array('I'), array('I'))
+            posting[0].append(i)
+            posting[1].append(count)
+    return postings
+
+
+def _overlaps(text: str, postings: Dict[str, Tuple[array, array]], size: int) -> List[int]:
+    """Số ký tự chung (tính cả lặp) giữa text và từng entry - giống quick_ratio của difflib"""
+    overlap = [0] * size
+    for ch, wanted in Counter(text).items():
+        posting = postings.get(ch)
+        if posting is None:
+            continue
+        ids, counts = posting
+        if wanted == 1:
+            for i in ids:
+                overlap[i] += 1
+        else:
+            for i, count in zip(ids, counts):
+                overlap[i] += count if count < wanted else wanted
+    return overlap
+
+
+def _ratio(a: str, b: str) -> float:
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+class MatchIndex:
+    """
+    Chỉ mục của knowledge base phục vụ find_best_match
+
+    Điểm của một entry giống hệt cách tính cũ:
+        max(ratio(tin nhắn, câu hỏi), ratio(tin nhắn mở rộng, câu hỏi mở rộng))
+        + 0.3 nếu tin nhắn chứa một từ khóa
+    Inverted index ký tự cho cận trên chính xác của ratio (như quick_ratio),
+    nên chỉ các entry có cận trên đủ cao mới phải chạy SequenceMatcher.
+    """
+
+    def __init__(self, entries: List[Dict], expand: Callable[[str], str], version: int = 0):
+        self.entries = entries
+        self.version = version  # data_version của knowledge base tạo ra chỉ mục này
+        self.questions = [e['question'].lower() for e in entries]
+        self.expanded_questions = [expand(q) for q in self.questions]
+        self.question_lengths = array('I', map(len, self.questions))
+        self.expanded_lengths = array('I', map(len, self.expanded_questions))
+        self.question_postings = _char_postings(self.questions)
+        self.expanded_postings = _char_postings(self.expanded_questions)
+
+        # Từ khóa -> các entry chứa từ khóa đó
+        self.keyword_postings: Dict[str, array] = {}
+        for i, entry in enumerate(entries):
+            keywords = (entry.get('keywords') or '').lower().split(',')
+            for kw in dict.fromkeys(kw.strip() for kw in keywords if kw.strip()):
+                self.keyword_postings.setdefault(kw, array('I')).append(i)
+
+    @classmethod
+    def from_snapshot(cls, snapshot, version: int = 0) -> 'MatchIndex':
+        """Dùng thẳng dữ liệu chỉ mục trong snapshot đã mmap (không tính lại, không copy)"""
+        index = cls.__new__(cls)
+        index.entries = snapshot.entries
+        index.version = version
+        index.questions = snapshot.columns['question_lower']
+        index.expanded_questions = snapshot.columns['question_expanded']
+        index.question_lengths = snapshot.uint32('question_lengths')
+        index.expanded_lengths = snapshot.uint32('expanded_lengths')
+        index.question_postings = snapshot.postings('question_postings', snapshot.meta['question_chars'])
+        index.expanded_postings = snapshot.postings('expanded_postings', snapshot.meta['expanded_chars'])
+        index.keyword_postings = snapshot.postings('keyword_postings', snapshot.meta['keywords'],
+                                                   with_counts=False)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def keyword_hits(self, expanded_message: str) -> bytearray:
+        """Đánh dấu các entry có từ khóa nằm trong tin nhắn"""
+        hits = bytearray(len(self.entries))
+        for kw, ids in self.keyword_postings.items():
+            if kw in expanded_message:
+                for i in ids:
+                    hits[i] = 1
+        return hits
+
+    def candidates(self, message: str, expanded_message: str, min_score: float = MIN_MATCH_SCORE,
+                   hits: Optional[bytearray] = None) -> List[Tuple[float, float, float, int]]:
+        """
+        Danh sách rút gọn các entry có thể đạt min_score
+
+        Returns:
+            List[(cận trên, cận trên ratio gốc, cận trên ratio mở rộng, vị trí)]
+            sắp xếp theo cận trên giảm dần
+        """
+        size = len(self.entries)
+        if hits is None:
+            hits = self.keyword_hits(expanded_message)
+        raw_overlap = _overlaps(message, self.question_postings, size)
+        expanded_overlap = _overlaps(expanded_message, self.expanded_postings, size)
+        message_len = len(message)
+        expanded_len = len(expanded_message)
+
+        shortlist = []
+        for i in range(size):
+            bound1 = 2.0 * raw_overlap[i] / (message_len + self.question_lengths[i])
+            bound2 = 2.0 * expanded_overlap[i] / (expanded_len + self.expanded_lengths[i])
+            bound = max(bound1, bound2)
+            if hits[i]:
+                bound += KEYWORD_BONUS
+            if bound >= min_score:
+                shortlist.append((bound, bound1, bound2, i))
+        shortlist.sort(key=lambda c: (-c[0], c[3]))
+        return shortlist
+
+    def score(self, i: int, message: str, expanded_message: str,
+              bound1: float, bound2: float, keyword_hit: bool) -> float:
+        """Điểm chính xác của entry i (bỏ qua ratio không thể thắng)"""
+        if bound1 >= bound2:
+            ratio = _ratio(message, self.questions[i])
+            if bound2 > ratio:
+                ratio = max(ratio, _ratio(expanded_message, self.expanded_questions[i]))
+        else:
+            ratio = _ratio(expanded_message, self.expanded_questions[i])
+            if bound1 > ratio:
+                ratio = max(ratio, _ratio(message, self.questions[i]))
+        if keyword_hit:
+            ratio += KEYWORD_BONUS
+        return ratio
+
+    def best_match(self, user_message: str, expanded_message: str,
+                   min_score: float = MIN_MATCH_SCORE) -> Tuple[Optional[int], float]:
+        """
+        Tìm entry có điểm cao nhất (entry đứng trước thắng khi bằng điểm)
+
+        Returns:
+            Tuple[Optional[int], float]: (vị trí entry hoặc None, điểm)
+        """
+        message = user_message.lower()
+        hits = self.keyword_hits(expanded_message)
+        best_index, best_score = None, 0.0
+        for bound, bound1, bound2, i in self.candidates(message, expanded_message, min_score, hits):
+            if best_index is not None and bound < best_score:
+                break  # Các ứng viên còn lại không thể vượt qua
+            score = self.score(i, message, expanded_message, bound1, bound2, hits[i])
+            if score > best_score or (score == best_score and best_index is not None and i < best_index):
+                best_index, best_score = i, score
+        if best_index is None or best_score < min_score:
+            return None, best_score
+        return best_index, best_score
+
+    def top_k(self, user_message: str, expanded_message: str, k: int,
+              min_score: float = MIN_RETRIEVAL_SCORE) -> List[Tuple[int, float]]:
+        """
+        Lấy k entry liên quan nhất (cùng cách chấm điểm với best_match)
+
+        Returns:
+            List[(vị trí entry, điểm)] sắp xếp theo điểm giảm dần
+        """
+        message = user_message.lower()
+        hits = self.keyword_hits(expanded_message)
+        heap: List[Tuple[float, int]] = []  # min-heap (điểm, -vị trí)
+        for bound, bound1, bound2, i in self.candidates(message, expanded_message, min_score, hits):
+            if len(heap) >= k and bound < heap[0][0]:
+                break
+            score = self.score(i, message, expanded_message, bound1, bound2, hits[i])
+            if score < min_score:
+                continue
+            item = (score, -i)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        return [(-neg_i, score) for score, neg_i in sorted(heap, reverse=True)]
+
+
+class SegmentedIndex:
+    """
+    Ghép chỉ mục của nhiều file (segment) thành một
+    Kết quả giống hệt một chỉ mục trên toàn bộ entry theo thứ tự các segment,
+    nhưng khi một file thay đổi chỉ cần build lại chỉ mục của file đó.
+    """
+
+    def __init__(self, segments: List, version: int = 0):
+        self.segments = segments
+        self.version = version
+        self.offsets = []
+        self.entries = []
+        for segment in segments:
+            self.offsets.append(len(self.entries))
+            self.entries.extend(segment.entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def best_match(self, user_message: str, expanded_message: str,
+                   min_score: float = MIN_MATCH_SCORE) -> Tuple[Optional[int], float]:
+        """Cùng giao diện với MatchIndex.best_match (segment đứng trước thắng khi bằng điểm)"""
+        best_index, best_score = None, 0.0
+        for offset, segment in zip(self.offsets, self.segments):
+            if not len(segment):
+                continue
+            floor = min_score if best_index is None else max(min_score, best_score)
+            i, score = segment.best_match(user_message, expanded_message, floor)
+            if i is not None and (best_index is None or score > best_score):
+                best_index, best_score = offset + i, score
+        return best_index, best_score
+
+    def top_k(self, user_message: str, expanded_message: str, k: int,
+              min_score: float = MIN_RETRIEVAL_SCORE) -> List[Tuple[int, float]]:
+        """Cùng giao diện với MatchIndex.top_k"""
+        merged = []
+        for offset, segment in zip(self.offsets, self.segments):
+            if len(segment):
+                merged.extend((offset + i, score)
+                              for i, score in segment.top_k(user_message, expanded_message, k, min_score))
+        merged.sort(key=lambda c: (-c[1], c[0]))
+        return merged[:k]
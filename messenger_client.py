@@ -0,0 +1,273 @@
+"""
+HTTP client cho Facebook Messenger Send API
+Dùng chung một Session (giữ kết nối keep-alive), có timeout, retry và đo độ trễ.
+Câu trả lời nhiều phần (text + hình) được gửi trong một Graph API batch request.
+AsyncMessengerClient làm điều tương tự trên event loop (chế độ ASGI, cần httpx).
+"""
+
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+except ImportError:  # httpx chỉ cần cho chế độ ASGI
+    httpx = None
+
+GRAPH_API_URL = "https://graph.facebook.com/v18.0"
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def batch_form(recipient_id: str, messages: List[Dict]) -> Dict:
+    """Form của Graph API batch request gửi các tin nhắn theo thứ tự (tin sau depends_on tin trước)"""
+    recipient = json.dumps({"id": recipient_id})
+    batch = []
+    for i, message in enumerate(messages):
+        request = {
+            "method": "POST",
+            "relative_url": "me/messages",
+            "name": f"msg{i}",
+            "body": urlencode({"recipient": recipient, "message": json.dumps(message)}),
+        }
+        if i:
+            request["depends_on"] = f"msg{i - 1}"
+        batch.append(request)
+    return {"batch": json.dumps(batch), "include_headers": "false"}
+
+
+def not_sent(error: requests.RequestException) -> bool:
+    """Lỗi xảy ra trước khi request tới Graph API (không kết nối được), gửi lại không bị trùng tin nhắn"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        # urllib3 bọc lỗi kết nối trong MaxRetryError; lỗi khi đang đọc (ProtocolError...) thì không chắc
+        reason = getattr(error.args[0], 'reason', error.args[0])
+        return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+    return False
+
+
+def batch_statuses(results: List) -> List[Optional[int]]:
+    """HTTP status của từng request trong batch (kết quả null: request không được thực hiện)"""
+    return [result.get('code') if result else None for result in results]
+
+
+class BaseMessengerClient:
+    """Phần dùng chung của client đồng bộ và async: thống kê độ trễ, đọc kết quả batch"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=500)
+        self.calls = 0
+        self.errors = 0
+        self.batches = 0
+
+    def _record(self, latency: float, ok: bool):
+        with self._lock:
+            self.calls += 1
+            if not ok:
+                self.errors += 1
+            self._latencies.append(latency)
+
+    def _batch_result(self, response, unsent: bool, count: int) -> Optional[List[Optional[int]]]:
+        """Status từng tin nhắn của batch, None nếu chắc chắn batch chưa được thực hiện (gửi lại từng tin)"""
+        if response is None:
+            # Lỗi đọc: batch có thể đã tới Facebook, gửi lại sẽ bị trùng tin nhắn
+            return None if unsent else [None] * count
+        if not (200 <= response.status_code < 300):
+            return None
+        try:
+            results = response.json()
+        except ValueError:
+            return [None] * count
+        with self._lock:
+            self.batches += 1
+        return batch_statuses(results)
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê độ trễ các lần gọi gần đây"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+        stats = {'calls': self.calls, 'errors': self.errors, 'batches': self.batches}
+        if latencies:
+            stats.update({
+                'avg_ms': round(sum(latencies) / len(latencies) * 1000, 1),
+                'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 1),
+                'max_ms': round(latencies[-1] * 1000, 1),
+            })
+        return stats
+
+
+class MessengerClient(BaseMessengerClient):
+    def __init__(self, page_token: str, pool_size: int = 4,
+                 connect_timeout: float = 3.05, read_timeout: float = 10,
+                 retries: int = 3, backoff: float = 0.5, base_url: str = GRAPH_API_URL,
+                 use_batch: bool = True):
+        """
+        Khởi tạo client
+
+        Args:
+            page_token: Facebook Page Access Token
+            pool_size: Số kết nối giữ sẵn (nên bằng số worker xử lý tin nhắn)
+            connect_timeout: Timeout kết nối (giây)
+            read_timeout: Timeout chờ phản hồi (giây)
+            retries: Số lần thử lại khi gặp lỗi 5xx / 429 hoặc lỗi kết nối
+            backoff: Hệ số backoff giữa các lần thử (0.5s, 1s, 2s...)
+            base_url: Địa chỉ Graph API (đổi được để test với server giả)
+            use_batch: Gộp các tin nhắn của cùng một câu trả lời vào một batch request
+        """
+        super().__init__()
+        self.page_token = page_token
+        self.base_url = base_url.rstrip('/')
+        self.use_batch = use_batch
+        self.timeout = (connect_timeout, read_timeout)
+
+        # Không retry lỗi đọc: request có thể đã tới Facebook, gửi lại sẽ bị trùng tin nhắn
+        retry = Retry(
+            total=retries, connect=retries, read=0, status=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET', 'POST']),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def post(self, path: str, **kwargs) -> Optional[requests.Response]:
+        """Gửi POST tới Graph API, trả về None nếu lỗi kết nối hoặc lỗi đọc"""
+        return self._post(path, **kwargs)[0]
+
+    def _post(self, path: str, **kwargs) -> Tuple[Optional[requests.Response], bool]:
+        """Như post, kèm cờ request chắc chắn chưa tới Facebook (gửi lại an toàn)"""
+        params = kwargs.pop('params', {})
+        params['access_token'] = self.page_token
+        url = f"{self.base_url}/{path.lstrip('/')}" if path else self.base_url
+        start = time.monotonic()
+        try:
+            response = self.session.post(url, params=params, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            print(f"Error calling Graph API: {e}")
+            self._record(time.monotonic() - start, ok=False)
+            return None, not_sent(e)
+        self._record(time.monotonic() - start, ok=response.ok)
+        return response, False
+
+    def send_message(self, recipient_id: str, message: Dict) -> Optional[requests.Response]:
+        """Gửi một tin nhắn (text hoặc attachment) tới người nhận"""
+        payload = {
+            "recipient": {"id": recipient_id},
+            "message": message,
+        }
+        return self.post("me/messages", json=payload)
+
+    def send_messages(self, recipient_id: str, messages: List[Dict]) -> List[Optional[int]]:
+        """
+        Gửi nhiều tin nhắn cho một người nhận, giữ đúng thứ tự
+
+        Dùng Graph API batch (một lần gọi HTTP); mỗi tin nhắn phụ thuộc tin nhắn
+        trước (depends_on) để Facebook thực hiện tuần tự. Chỉ gửi lần lượt từng
+        tin nhắn khi chắc chắn batch chưa được thực hiện (không kết nối được hoặc
+        Facebook trả lỗi cho cả batch); timeout khi chờ trả lời thì không gửi lại.
+
+        Returns:
+            List[Optional[int]]: HTTP status của từng tin nhắn (None nếu không gửi được)
+        """
+        if len(messages) > 1 and self.use_batch:
+            statuses = self._send_batch(recipient_id, messages)
+            if statuses is not None:
+                return statuses
+
+        statuses = []
+        for message in messages:
+            response = self.send_message(recipient_id, message)
+            statuses.append(response.status_code if response is not None else None)
+        return statuses
+
+    def _send_batch(self, recipient_id: str, messages: List[Dict]) -> Optional[List[Optional[int]]]:
+        """Status từng tin nhắn, None nếu nên gửi lại từng tin"""
+        response, unsent = self._post("", data=batch_form(recipient_id, messages))
+        return self._batch_result(response, unsent, len(messages))
+
+
+class AsyncMessengerClient(BaseMessengerClient):
+    """
+    Giống MessengerClient nhưng gửi bằng httpx.AsyncClient trên event loop (chế độ ASGI)
+    Retry cùng quy tắc: lỗi kết nối và status 429/5xx, không retry khi lỗi đọc.
+    """
+
+    def __init__(self, page_token: str, pool_size: int = 16,
+                 connect_timeout: float = 3.05, read_timeout: float = 10,
+                 retries: int = 3, backoff: float = 0.5, base_url: str = GRAPH_API_URL,
+                 use_batch: bool = True):
+        """Tham số giống MessengerClient; pool_size là số kết nối đồng thời tối đa"""
+        if httpx is None:
+            raise ImportError("Chế độ ASGI cần httpx (pip install httpx)")
+        super().__init__()
+        self.page_token = page_token
+        self.base_url = base_url.rstrip('/')
+        self.use_batch = use_batch
+        self.retries = retries
+        self.backoff = backoff
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size))
+
+    async def post(self, path: str, **kwargs) -> Optional['httpx.Response']:
+        """Gửi POST tới Graph API, trả về None nếu lỗi kết nối hoặc lỗi đọc"""
+        return (await self._post(path, **kwargs))[0]
+
+    async def _post(self, path: str, **kwargs) -> Tuple[Optional['httpx.Response'], bool]:
+        """Như post, kèm cờ request chắc chắn chưa tới Facebook (gửi lại an toàn)"""
+        params = kwargs.pop('params', {})
+        params['access_token'] = self.page_token
+        url = f"{self.base_url}/{path.lstrip('/')}" if path else self.base_url
+        for attempt in range(self.retries + 1):
+            start = time.monotonic()
+            try:
+                response = await self.client.post(url, params=params, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+                self._record(time.monotonic() - start, ok=False)
+                if attempt == self.retries:
+                    print(f"Error calling Graph API: {e}")
+                    return None, True
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+                continue
+            except httpx.HTTPError as e:
+                # Lỗi đọc: request có thể đã tới Facebook, gửi lại sẽ bị trùng tin nhắn
+                print(f"Error calling Graph API: {e}")
+                self._record(time.monotonic() - start, ok=False)
+                return None, False
+            self._record(time.monotonic() - start, ok=response.is_success)
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                return response, False
+            retry_after = response.headers.get('Retry-After', '')
+            await asyncio.sleep(float(retry_after) if retry_after.isdigit() else self.backoff * 2 ** attempt)
+        return None, False
+
+    async def send_messages(self, recipient_id: str, messages: List[Dict]) -> List[Optional[int]]:
+        """Gửi nhiều tin nhắn cho một người nhận, giữ đúng thứ tự (như MessengerClient.send_messages)"""
+        if len(messages) > 1 and self.use_batch:
+            response, unsent = await self._post("", data=batch_form(recipient_id, messages))
+            statuses = self._batch_result(response, unsent, len(messages))
+            if statuses is not None:
+                return statuses
+
+        statuses = []
+        for message in messages:
+            response = await self.post("me/messages", json={"recipient": {"id": recipient_id}, "message": message})
+            statuses.append(response.status_code if response is not None else None)
+        return statuses
+
+    async def close(self):
+        await self.client.aclose()
@@ -0,0 +1,81 @@
+"""
+Mở rộng từ viết tắt trong tin nhắn
+Từ điển viết tắt được biên dịch thành trie theo từ (hỗ trợ mục nhiều từ như "đổi trả"),
+tin nhắn được quét một lượt, lấy mục khớp dài nhất. Kết quả được nhớ trong LRU cache
+vì cùng một tin nhắn được mở rộng nhiều lần khi xử lý.
+"""
+
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+_PUNCTUATION = re.compile(r'[^\w\s]')
+
+
+def clean_word(word: str) -> str:
+    """Bỏ dấu câu khỏi một từ (từ chỉ gồm chữ/số thì giữ nguyên, không cần chạy regex)"""
+    return word if word.isalnum() else _PUNCTUATION.sub('', word)
+
+
+class _Node:
+    __slots__ = ('value', 'children')
+
+    def __init__(self):
+        self.value: Optional[str] = None
+        self.children: Dict[str, '_Node'] = {}
+
+
+class Normalizer:
+    """
+    Bộ mở rộng viết tắt đã biên dịch (không đổi sau khi tạo; thêm viết tắt thì tạo bộ mới)
+
+    Mỗi từ được so sau khi bỏ dấu câu; từ được thay thì mất dấu câu,
+    từ không thay giữ nguyên như trong tin nhắn (đã viết thường).
+    """
+
+    def __init__(self, abbreviations: Dict[str, str], cache_size: int = 4096):
+        self.root = _Node()
+        self.size = 0
+        for abbr, full in abbreviations.items():
+            words = [clean_word(w) for w in abbr.lower().split()]
+            if not words:
+                continue
+            node = self.root
+            for word in words:
+                node = node.children.setdefault(word, _Node())
+            node.value = full
+            self.size += 1
+        self.expand = lru_cache(maxsize=cache_size)(self.expand_uncached)
+
+    def expand_uncached(self, text: str) -> str:
+        """Mở rộng viết tắt (không qua cache, dùng khi build chỉ mục)"""
+        words = text.lower().split()
+        cleaned = [clean_word(w) for w in words]
+        expanded: List[str] = []
+        root = self.root.children
+        i, n = 0, len(words)
+        while i < n:
+            node = root.get(cleaned[i])
+            match, end = None, i + 1
+            j = i + 1
+            while node is not None:
+                if node.value is not None:
+                    match, end = node.value, j
+                if j == n:
+                    break
+                node = node.children.get(cleaned[j])
+                j += 1
+            expanded.append(match if match is not None else words[i])
+            i = end
+        return ' '.join(expanded)
+
+    def get_stats(self) -> Dict:
+        info = self.expand.cache_info()
+        lookups = info.hits + info.misses
+        return {
+            'abbreviations': self.size,
+            'cache_size': info.currsize,
+            'cache_hits': info.hits,
+            'cache_misses': info.misses,
+            'cache_hit_rate': round(info.hits / lookups, 3) if lookups else 0.0,
+        }
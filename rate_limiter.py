@@ -0,0 +1,173 @@
+"""
+Giới hạn lời gọi Gemini theo quota
+Token bucket cho số request/phút (RPM) và số token/phút (TPM) của cả API key,
+cộng một bucket RPM nhỏ cho từng khách để một người nhắn dồn dập không dùng hết quota.
+"""
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class TokenBucket:
+    """Bucket nạp lại đều theo thời gian, cho phép âm (nợ) khi ghi nhận token thực tế sau khi gọi"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.level
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Số giây phải chờ để có đủ amount (inf nếu vượt dung lượng bucket)"""
+        missing = amount - self.refill(now)
+        if missing <= 0:
+            return 0.0
+        if amount > self.capacity:
+            return float('inf')
+        return missing / self.rate
+
+
+def split_quota(rpm: float, tpm: float, workers: int, min_tokens: int) -> Tuple[float, float]:
+    """
+    Quota mỗi worker khi chia đều quota của API key cho `workers` process
+
+    Không để bucket nhỏ hơn một lời gọi (1 request, `min_tokens` token): bucket như vậy không bao giờ
+    đủ cho một lời gọi và mọi tin nhắn bị trả lời 'limited'. Khi phải nâng lên thì tổng quota
+    các worker vượt quota đã cấu hình, có cảnh báo.
+
+    Args:
+        rpm, tpm: Quota của cả API key (request / token mỗi phút)
+        workers: Số worker dùng chung API key
+        min_tokens: Số token của một prompt lớn nhất
+    """
+    worker_rpm = max(rpm / workers, 1.0)
+    worker_tpm = max(tpm / workers, float(min_tokens))
+    if worker_rpm * workers > rpm or worker_tpm * workers > tpm:
+        print(f"⚠️ Quota Gemini ({rpm:g} request, {tpm:g} token mỗi phút) không đủ chia cho {workers} worker, "
+              f"mỗi worker dùng {worker_rpm:g} request, {worker_tpm:g} token mỗi phút")
+    return worker_rpm, worker_tpm
+
+
+class QuotaLimiter:
+    def __init__(self, rpm: float = 15, tpm: float = 1000000, user_rpm: float = 4,
+                 max_wait: float = 2.0, max_users: int = 10000):
+        """
+        Args:
+            rpm: Số lời gọi Gemini tối đa mỗi phút (cả API key)
+            tpm: Số token tối đa mỗi phút (cả API key)
+            user_rpm: Số lời gọi Gemini tối đa mỗi phút cho một khách
+            max_wait: Thời gian tối đa chờ quota chung nạp lại trước khi bỏ qua Gemini (giây)
+            max_users: Số khách tối đa theo dõi bucket riêng
+        """
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.user_rpm = user_rpm
+        self.max_wait = max_wait
+        self.max_users = max_users
+        self._users: OrderedDict = OrderedDict()  # user_id -> TokenBucket
+        self._lock = threading.Lock()
+
+        self.allowed = 0
+        self.waited = 0  # Lời gọi được phép sau khi chờ quota nạp lại
+        self.limited = {'user': 0, 'rpm': 0, 'tpm': 0}
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+
+    def _user_bucket(self, user_id: str) -> TokenBucket:
+        bucket = self._users.get(user_id)
+        if bucket is None:
+            bucket = self._users[user_id] = TokenBucket(self.user_rpm)
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+        return bucket
+
+    def acquire(self, user_id: Optional[str], tokens: int, max_wait: Optional[float] = None) -> Optional[str]:
+        """
+        Xin quota cho một lời gọi Gemini có khoảng `tokens` token đầu vào
+
+        Args:
+            user_id: Khách gửi tin nhắn (None: không tính vào quota của khách, VD: lời gọi hedge)
+            tokens: Số token ước lượng của prompt
+            max_wait: Thời gian chờ tối đa (mặc định self.max_wait)
+
+        Returns:
+            None nếu được gọi, không thì lý do: 'user' | 'rpm' | 'tpm'
+        """
+        deadline = time.monotonic() + (self.max_wait if max_wait is None else max_wait)
+        waited = False
+        while True:
+            reason, wait = self._try_acquire(user_id, tokens, deadline, waited)
+            if not wait:
+                return reason
+            waited = True
+            time.sleep(wait)
+
+    async def acquire_async(self, user_id: Optional[str], tokens: int,
+                            max_wait: Optional[float] = None) -> Optional[str]:
+        """Giống acquire nhưng chờ bằng asyncio.sleep (dùng trong event loop)"""
+        deadline = time.monotonic() + (self.max_wait if max_wait is None else max_wait)
+        waited = False
+        while True:
+            reason, wait = self._try_acquire(user_id, tokens, deadline, waited)
+            if not wait:
+                return reason
+            waited = True
+            await asyncio.sleep(wait)
+
+    def _try_acquire(self, user_id: Optional[str], tokens: int, deadline: float,
+                     waited: bool) -> Tuple[Optional[str], float]:
+        """Một lần xin quota: (None, 0) được gọi, (lý do, 0) bị từ chối, (None, số giây) cần chờ thêm"""
+        with self._lock:
+            now = time.monotonic()
+            user = self._user_bucket(user_id) if user_id is not None else None
+            # Khách vượt quota riêng thì không chờ, nhường quota chung cho khách khác
+            if user is not None and user.wait_time(1, now) > 0:
+                self.limited['user'] += 1
+                return 'user', 0.0
+            waits = {'rpm': self.requests.wait_time(1, now), 'tpm': self.tokens.wait_time(tokens, now)}
+            reason = max(waits, key=waits.get)
+            wait = waits[reason]
+            if wait == 0:
+                self.requests.level -= 1
+                self.tokens.level -= tokens
+                if user is not None:
+                    user.level -= 1
+                self.allowed += 1
+                self.waited += waited
+                self.prompt_tokens += tokens
+                return None, 0.0
+            if now + wait > deadline:
+                self.limited[reason] += 1
+                return reason, 0.0
+            return None, wait
+
+    def record_output(self, tokens: int):
+        """Ghi nhận token của câu trả lời (chỉ biết sau khi gọi xong, bucket có thể âm)"""
+        with self._lock:
+            self.tokens.level -= tokens
+            self.output_tokens += tokens
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê quota"""
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'allowed': self.allowed,
+                'waited': self.waited,
+                'limited': dict(self.limited),
+                'prompt_tokens': self.prompt_tokens,
+                'output_tokens': self.output_tokens,
+                'requests_available': round(self.requests.refill(now), 1),
+                'tokens_available': round(self.tokens.refill(now)),
+                'tracked_users': len(self._users),
+            }
@@ -0,0 +1,72 @@
+"""
+Cache câu trả lời cho các câu hỏi lặp lại
+LRU có giới hạn kích thước + TTL, an toàn khi dùng từ nhiều thread.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable
+
+
+class ResponseCache:
+    def __init__(self, max_size: int = 1000, ttl: float = 3600):
+        """
+        Args:
+            max_size: Số câu trả lời tối đa giữ trong cache
+            ttl: Thời gian sống của một câu trả lời (giây)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict = OrderedDict()  # key -> (hết hạn lúc, giá trị)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable):
+        """Lấy giá trị còn hạn, None nếu không có"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Hashable, value):
+        """Lưu giá trị, đẩy bỏ mục ít dùng nhất khi đầy"""
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def bypass(self):
+        """Ghi nhận một lần không dùng cache (câu hỏi phụ thuộc ngữ cảnh)"""
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê cache"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+            }
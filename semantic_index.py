@@ -0,0 +1,200 @@
+"""
+Semantic matcher cho knowledge base (tùy chọn, cần numpy)
+Vector hóa câu hỏi bằng TF-IDF trên n-gram ký tự + từ, băm vào số chiều cố định.
+Toàn bộ vector nằm trong một ma trận NumPy liên tục; mỗi tin nhắn chỉ cần
+một phép nhân ma trận-vector. Ma trận được lưu xuống đĩa để không tính lại khi khởi động.
+"""
+
+import hashlib
+import math
+import os
+import time
+import zipfile
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # numpy là tùy chọn
+    np = None
+
+from match_index import KEYWORD_BONUS, MIN_MATCH_SCORE, MIN_RETRIEVAL_SCORE, MatchIndex
+
+INDEX_FORMAT = 1  # Tăng khi đổi cách vector hóa để bỏ file cache cũ
+CACHE_GRACE = 3600  # Chỉ xóa file cache không dùng quá 1 giờ (worker khác có thể đang dùng bản dữ liệu khác)
+
+
+def is_available() -> bool:
+    """Semantic matcher chỉ dùng được khi đã cài numpy"""
+    return np is not None
+
+
+def cache_file_name(digest: str) -> str:
+    return f"semantic-{digest}.npz"
+
+
+def prune_cache(cache_dir: str, keep: Set[str], grace: float = CACHE_GRACE):
+    """
+    Xóa file cache của các chỉ mục không còn dùng (digest không nằm trong keep)
+    File được ghi / đọc trong `grace` giây gần đây thì giữ lại: khi reload lần lượt từng worker,
+    worker chưa reload vẫn dùng bản dữ liệu cũ và không phải tính lại ma trận.
+    """
+    keep_names = {cache_file_name(digest) for digest in keep}
+    cutoff = time.time() - grace
+    for path in Path(cache_dir).glob(cache_file_name('*')):
+        if path.name in keep_names:
+            continue
+        try:
+            if path.stat().st_mtime < cutoff:
+                # Worker khác có thể vừa xóa file này
+                path.unlink(missing_ok=True)
+        except OSError as e:
+            print(f"⚠️ Không xóa được file cache semantic {path.name}: {e}")
+
+
+class HashingVectorizer:
+    def __init__(self, dim: int = 2048, ngram_sizes: Tuple[int, ...] = (2, 3, 4)):
+        """
+        Args:
+            dim: Số chiều vector (số bucket băm)
+            ngram_sizes: Độ dài các n-gram ký tự
+        """
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+
+    def features(self, text: str) -> Counter:
+        """Đếm số lần xuất hiện của từng bucket (n-gram ký tự và từ)"""
+        counts = Counter()
+        words = text.split()
+        padded = f" {' '.join(words)} "
+        for n in self.ngram_sizes:
+            for i in range(len(padded) - n + 1):
+                counts[zlib.crc32(padded[i:i + n].encode('utf-8')) % self.dim] += 1
+        for word in words:
+            counts[zlib.crc32(b'w:' + word.encode('utf-8')) % self.dim] += 1
+        return counts
+
+    def signature(self) -> str:
+        return f"v{INDEX_FORMAT}-d{self.dim}-n{'.'.join(map(str, self.ngram_sizes))}"
+
+
+class SemanticIndex:
+    """
+    Chỉ mục vector trên các câu hỏi đã mở rộng viết tắt của MatchIndex
+
+    Điểm = cosine(tin nhắn, câu hỏi) + 0.3 nếu khớp từ khóa, cùng thang điểm
+    với fuzzy matcher nên dùng chung các ngưỡng.
+    """
+
+    def __init__(self, match_index: MatchIndex, cache_dir: Optional[str] = None,
+                 vectorizer: Optional[HashingVectorizer] = None):
+        if np is None:
+            raise ImportError("Semantic matcher cần numpy (pip install numpy)")
+        self.match_index = match_index
+        self.entries = match_index.entries
+        self.version = match_index.version
+        self.vectorizer = vectorizer or HashingVectorizer()
+
+        texts = match_index.expanded_questions
+        digest = hashlib.sha1(self.vectorizer.signature().encode('utf-8'))
+        for text in texts:
+            digest.update(text.encode('utf-8'))
+            digest.update(b'\0')
+        self.digest = digest.hexdigest()
+
+        cache_file = Path(cache_dir) / cache_file_name(self.digest) if cache_dir else None
+        if cache_file is None or not self._load(cache_file):
+            self._build(texts)
+            if cache_file is not None:
+                self._save(cache_file)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _load(self, cache_file: Path) -> bool:
+        """Đọc ma trận đã lưu; False nếu chưa có hoặc file hỏng (tính lại)"""
+        if not cache_file.exists():
+            return False
+        try:
+            with np.load(cache_file) as data:
+                matrix = np.ascontiguousarray(data['matrix'])
+                idf = data['idf']
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print(f"⚠️ File cache semantic hỏng, tính lại: {cache_file.name} ({e})")
+            return False
+        if matrix.shape != (len(self.entries), self.vectorizer.dim) or idf.shape != (self.vectorizer.dim,):
+            print(f"⚠️ File cache semantic không khớp, tính lại: {cache_file.name}")
+            return False
+        self.matrix = matrix
+        self.idf = idf
+        try:
+            # Đánh dấu file đang được dùng để prune_cache của worker khác không xóa
+            os.utime(cache_file)
+        except OSError:
+            pass
+        return True
+
+    def _build(self, texts: List[str]):
+        dim = self.vectorizer.dim
+        features = [self.vectorizer.features(text) for text in texts]
+        df = np.zeros(dim, dtype=np.float32)
+        for counts in features:
+            df[list(counts)] += 1
+        self.idf = (np.log((1 + len(texts)) / (1 + df)) + 1).astype(np.float32)
+
+        self.matrix = np.zeros((len(texts), dim), dtype=np.float32)
+        for row, counts in zip(self.matrix, features):
+            for bucket, count in counts.items():
+                row[bucket] = (1 + math.log(count)) * self.idf[bucket]
+        norms = np.linalg.norm(self.matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.matrix /= norms
+
+    def _save(self, cache_file: Path):
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # Tên file tạm riêng cho từng process và không khớp glob của prune_cache
+        tmp = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(f, matrix=self.matrix, idf=self.idf)
+        os.replace(tmp, cache_file)
+
+    def embed(self, text: str):
+        """Vector (đã chuẩn hóa) của một tin nhắn"""
+        vector = np.zeros(self.vectorizer.dim, dtype=np.float32)
+        for bucket, count in self.vectorizer.features(text).items():
+            vector[bucket] = (1 + math.log(count)) * self.idf[bucket]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def scores(self, expanded_message: str):
+        """Điểm của tất cả entry: một phép nhân ma trận-vector + điểm cộng từ khóa"""
+        scores = self.matrix @ self.embed(expanded_message)
+        hits = self.match_index.keyword_hits(expanded_message)
+        if any(hits):
+            scores += np.frombuffer(bytes(hits), dtype=np.uint8) * np.float32(KEYWORD_BONUS)
+        return scores
+
+    def best_match(self, user_message: str, expanded_message: str,
+                   min_score: float = MIN_MATCH_SCORE) -> Tuple[Optional[int], float]:
+        """Cùng giao diện với MatchIndex.best_match"""
+        if not len(self):
+            return None, 0.0
+        scores = self.scores(expanded_message)
+        best = int(np.argmax(scores))  # argmax lấy entry đứng trước khi bằng điểm
+        score = float(scores[best])
+        if score < min_score:
+            return None, score
+        return best, score
+
+    def top_k(self, user_message: str, expanded_message: str, k: int,
+              min_score: float = MIN_RETRIEVAL_SCORE) -> List[Tuple[int, float]]:
+        """Cùng giao diện với MatchIndex.top_k"""
+        if not len(self):
+            return []
+        scores = self.scores(expanded_message)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = sorted(top, key=lambda i: (-scores[i], i))
+        return [(int(i), float(scores[i])) for i in top if scores[i] >= min_score]
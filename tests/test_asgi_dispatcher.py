@@ -0,0 +1,44 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+
+# Import app.py tạo thư mục data và file hàng đợi trong thư mục hiện tại: chạy trong thư mục tạm
+cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp())
+try:
+    from asgi_app import AsyncSenderDispatcher
+except ImportError:  # Chế độ ASGI cần asgiref
+    AsyncSenderDispatcher = None
+finally:
+    os.chdir(cwd)
+
+
+@unittest.skipIf(AsyncSenderDispatcher is None, "cần asgiref")
+class AsyncDebounceTest(unittest.TestCase):
+    def test_debounce_matches_sync_dispatcher(self):
+        """Tin nhắn liên tục được gộp, nhưng không chờ quá 3 × debounce (giống SenderDispatcher)"""
+        batches = []
+
+        async def handler(sender_id, messages):
+            batches.append((time.monotonic(), messages))
+
+        async def run():
+            dispatcher = AsyncSenderDispatcher(handler, debounce=0.1)
+            start = time.monotonic()
+            for i in range(12):
+                dispatcher.dispatch('user', i)
+                await asyncio.sleep(0.05)
+            await asyncio.sleep(0.3)
+            return start
+
+        start = asyncio.run(run())
+        self.assertGreater(len(batches), 1)
+        self.assertEqual([m for _, batch in batches for m in batch], list(range(12)))
+        self.assertLess(batches[0][0] - start, 0.3 + 0.05)
+        self.assertGreater(len(batches[0][1]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import os
+import tempfile
+import time
+import unittest
+
+from conversation_store import SQLiteConversationStore
+
+
+class SQLiteConversationStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'conversations.db')
+
+    def make_store(self, **kwargs):
+        store = SQLiteConversationStore(self.path, flush_interval=60, **kwargs)
+        self.addCleanup(store.close)
+        return store
+
+    def test_evicted_user_loses_cached_history(self):
+        store = self.make_store(max_users=3)
+        for i in range(7):
+            store.append(f"user-{i}", 'hỏi', 'đáp')
+            time.sleep(0.01)
+        store.flush()
+        store._maintain()
+
+        self.assertEqual(store.get('user-0'), [])
+        self.assertEqual(len(store.get('user-6')), 2)
+        self.assertEqual(sum(1 for i in range(7) if store.get(f"user-{i}")), 3)
+        self.assertEqual(store.get_stats()['cached_users'], 3)
+
+    def test_clear_by_other_worker(self):
+        store, other = self.make_store(), self.make_store()
+        store.append('user', 'hỏi', 'đáp')
+        store.flush()
+        self.assertEqual(len(other.get('user')), 2)
+
+        other.clear()
+        self.assertEqual(store.get('user'), [])
+
+    def test_unflushed_turn_is_kept(self):
+        store = self.make_store()
+        store.append('user', 'hỏi', 'đáp')
+        self.assertEqual(len(store.get('user')), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
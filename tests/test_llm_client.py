@@ -0,0 +1,44 @@
+import asyncio
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from llm_client import LLMClient
+
+
+class EchoModel:
+    def generate_content(self, contents):
+        return SimpleNamespace(text=' ok ')
+
+
+def llm_loop_threads():
+    return [thread for thread in threading.enumerate() if thread.name == 'llm-loop' and thread.is_alive()]
+
+
+class BindLoopTest(unittest.TestCase):
+    def test_bind_keeps_stats_and_stops_private_loop(self):
+        before = len(llm_loop_threads())
+        client = LLMClient(timeout=0.2, hedge_percentile=None)
+        self.assertEqual(len(llm_loop_threads()), before + 1)
+        for _ in range(3):
+            self.assertEqual(client.generate(EchoModel(), []), 'ok')
+
+        async def serve():
+            client.bind_loop(asyncio.get_running_loop())
+            client.bind_loop(asyncio.get_running_loop())  # Gọi lại mỗi lượt xử lý: không làm gì
+            return await client.generate_async(EchoModel(), [])
+
+        self.assertEqual(asyncio.run(serve()), 'ok')
+        stats = client.get_stats()
+        self.assertEqual(stats['calls'], 4)
+        self.assertEqual(len(client.latencies), 4)
+
+        deadline = time.monotonic() + 5
+        while len(llm_loop_threads()) > before and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(len(llm_loop_threads()), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+import unittest
+
+from rate_limiter import QuotaLimiter, split_quota
+
+
+class SplitQuotaTest(unittest.TestCase):
+    def test_even_split(self):
+        self.assertEqual(split_quota(15, 1000000, 3, 4000), (5.0, 1000000 / 3))
+
+    def test_share_below_one_call_is_raised(self):
+        rpm, tpm = split_quota(2, 6000, 4, 5000)
+        self.assertEqual((rpm, tpm), (1.0, 5000.0))
+        # Bucket mỗi worker vẫn đủ cho một lời gọi với prompt lớn nhất
+        limiter = QuotaLimiter(rpm, tpm, max_wait=0)
+        self.assertIsNone(limiter.acquire('user', 5000))
+
+    def test_unclamped_share_would_limit_every_call(self):
+        limiter = QuotaLimiter(2 / 4, 6000 / 4, max_wait=0)
+        self.assertEqual(limiter.acquire('user', 100), 'rpm')
+
+
+if __name__ == '__main__':
+    unittest.main()
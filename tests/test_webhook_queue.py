@@ -0,0 +1,66 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from webhook_queue import QueueConsumer, WebhookQueue
+from workers import SenderDispatcher, WorkerPool
+
+
+class LeaseRenewalTest(unittest.TestCase):
+    def test_handler_outliving_lease_runs_once(self):
+        """Hai worker dùng chung hàng đợi: tin xử lý lâu hơn lease không bị worker kia lấy lại"""
+        path = os.path.join(tempfile.mkdtemp(), 'queue.db')
+        lease = 0.3
+        queues = [WebhookQueue(path, lease=lease) for _ in range(2)]
+        handled = []
+        lock = threading.Lock()
+
+        def make_dispatch(queue):
+            def dispatch(event):
+                def work():
+                    time.sleep(lease * 4)
+                    with lock:
+                        handled.append(event['mid'])
+                    queue.ack([event['id']])
+                threading.Thread(target=work, daemon=True).start()
+                return True
+            return dispatch
+
+        consumers = [QueueConsumer(queue, make_dispatch(queue), capacity=lambda: 10, poll_interval=0.02)
+                     for queue in queues]
+        for consumer in consumers:
+            consumer.start()
+        queues[0].put([{'mid': f"m{i}", 'sender_id': 's', 'text': 't'} for i in range(5)])
+
+        deadline = time.monotonic() + 10
+        while queues[0].get_stats()['pending'] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        time.sleep(lease * 2)
+        for consumer in consumers:
+            consumer.stop()
+
+        self.assertEqual(sorted(handled), [f"m{i}" for i in range(5)])
+        self.assertEqual(sum(queue.get_stats()['claimed'] for queue in queues), 5)
+        self.assertGreater(sum(queue.get_stats()['renewed'] for queue in queues), 0)
+
+
+class DispatcherCapacityTest(unittest.TestCase):
+    def test_capacity_counts_debounced_messages(self):
+        pool = WorkerPool(1, queue_size=10)
+        done = threading.Event()
+        dispatcher = SenderDispatcher(pool, lambda sender_id, messages: done.set(), debounce=0.2, queue_size=3)
+        dispatcher.dispatch('a', 1)
+        dispatcher.dispatch('b', 2)
+        # Tin đang chờ gộp trong debounce vẫn chiếm chỗ
+        self.assertEqual(dispatcher.capacity(), 1)
+        self.assertTrue(done.wait(2))
+        deadline = time.monotonic() + 2
+        while dispatcher.capacity() < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(dispatcher.capacity(), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
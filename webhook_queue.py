@@ -0,0 +1,323 @@
+"""
+Hàng đợi webhook bền vững trên SQLite
+Webhook chỉ ghi tin nhắn vào hàng đợi rồi trả 200 ngay; QueueConsumer lấy tin nhắn ra
+đưa cho worker pool. Tin nhắn chỉ bị xóa khỏi hàng đợi sau khi đã trả lời xong (ack),
+nên process bị restart giữa chừng thì tin nhắn được xử lý lại (at-least-once).
+Lease của tin nhắn đã lấy được gia hạn định kỳ tới khi ack/nack, nên tin đang chờ pool
+hoặc chờ Gemini chậm không bị worker khác lấy lại; chỉ hết hạn khi process giữ nó đã chết.
+Tin nhắn trùng mid với tin đang chờ bị bỏ qua khi ghi; mid đã trả lời xong do DedupeIndex nhớ.
+"""
+
+import asyncio
+import atexit
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List
+
+DEAD = 2  # state của tin nhắn lỗi quá max_attempts
+
+
+class WebhookQueue:
+    MAINTENANCE_INTERVAL = 60  # Dọn tin nhắn đã xử lý mỗi 60 giây
+
+    def __init__(self, path: str, lease: float = 60.0, max_attempts: int = 5,
+                 retention: float = 86400, retry_delay: float = 5.0):
+        """
+        Args:
+            path: File SQLite (dùng chung giữa các worker gunicorn)
+            lease: Thời gian giữ tin nhắn đã lấy ra, gia hạn mỗi lease/3 giây tới khi ack/nack;
+                process chết thì quá hạn và consumer khác lấy lại (giây)
+            max_attempts: Số lần xử lý tối đa, quá thì đánh dấu lỗi và không thử nữa
+            retention: Giữ tin nhắn lỗi (dead letter) bao lâu để xem lại (giây)
+            retry_delay: Chờ bao lâu trước khi thử lại tin nhắn xử lý lỗi (giây)
+        """
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self.retry_delay = retry_delay
+
+        # synchronous=NORMAL với WAL: commit vẫn còn khi process chết (chỉ mất khi mất điện)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=5, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS webhook_events ("
+                         "id INTEGER PRIMARY KEY AUTOINCREMENT, mid TEXT UNIQUE, "
+                         "sender_id TEXT NOT NULL, text TEXT NOT NULL, received REAL NOT NULL, "
+                         "available REAL NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, "
+                         "state INTEGER NOT NULL DEFAULT 0)")
+        # state: 0 chờ, 2 lỗi (dead letter); 1 là tin đã xử lý của bản cũ (giờ ack xóa luôn),
+        # không dùng lại để file cũ không bị hiểu nhầm, maintain() dọn theo retention
+        self._db.execute("CREATE INDEX IF NOT EXISTS webhook_events_ready "
+                         "ON webhook_events(state, available)")
+        self._db_lock = threading.Lock()
+        self._ready = threading.Condition()  # Báo consumer trong cùng process có tin mới
+        self._held: Dict[int, int] = {}  # id -> attempts của lần lấy, các tin process này đang xử lý
+
+        self.enqueued = 0
+        self.duplicates = 0
+        self.claimed = 0
+        self.acked = 0
+        self.retried = 0
+        self.dead = 0
+        self.renewed = 0
+        self.lost = 0  # Tin đang giữ mà lease đã bị consumer khác lấy lại
+        self._next_maintenance = time.monotonic()
+        self._next_renewal = time.monotonic()
+        self._closed = False
+        atexit.register(self.close)
+
+    def _transaction(self, fn: Callable):
+        """Chạy fn trong transaction ghi (BEGIN IMMEDIATE: khóa ghi ngay, tránh deadlock giữa các worker)"""
+        with self._db_lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._db)
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+            return result
+
+    def put(self, events: List[Dict]) -> int:
+        """
+        Ghi các tin nhắn của một webhook POST (một transaction, đã commit khi trả về)
+
+        Args:
+            events: [{'mid', 'sender_id', 'text'}]
+
+        Returns:
+            int: Số tin nhắn mới (không tính tin trùng mid với tin đang chờ)
+        """
+        if not events:
+            return 0
+        now = time.time()
+        rows = [(e.get('mid'), e['sender_id'], e['text'], now, now) for e in events]
+
+        def insert(db):
+            before = db.total_changes
+            db.executemany("INSERT OR IGNORE INTO webhook_events (mid, sender_id, text, received, available) "
+                           "VALUES (?, ?, ?, ?, ?)", rows)
+            return db.total_changes - before
+
+        added = self._transaction(insert)
+        with self._ready:
+            self.enqueued += added
+            self.duplicates += len(rows) - added
+            if added:
+                self._ready.notify_all()
+        return added
+
+    def claim(self, limit: int) -> List[Dict]:
+        """Lấy tối đa `limit` tin nhắn sẵn sàng (cũ trước), giữ chúng trong `lease` giây"""
+        if limit <= 0:
+            return []
+        now = time.time()
+
+        def take(db):
+            rows = db.execute("SELECT id, mid, sender_id, text, received, attempts FROM webhook_events "
+                              "WHERE state = 0 AND available <= ? ORDER BY id LIMIT ?", (now, limit)).fetchall()
+            db.executemany("UPDATE webhook_events SET available = ?, attempts = attempts + 1 WHERE id = ?",
+                           [(now + self.lease, row[0]) for row in rows])
+            return rows
+
+        rows = self._transaction(take)
+        with self._ready:
+            self.claimed += len(rows)
+            self._held.update((row[0], row[5] + 1) for row in rows)
+        return [{'id': row[0], 'mid': row[1], 'sender_id': row[2], 'text': row[3],
+                 'received': row[4], 'attempts': row[5] + 1} for row in rows]
+
+    def _drop_held(self, ids: List[int]):
+        """Thôi gia hạn lease (gọi trước transaction ack/nack/release, xem renew)"""
+        with self._ready:
+            for i in ids:
+                self._held.pop(i, None)
+
+    def ack(self, ids: List[int]):
+        """Xóa tin nhắn đã xử lý xong khỏi hàng đợi"""
+        self._drop_held(ids)
+        self._transaction(lambda db: db.executemany(
+            "DELETE FROM webhook_events WHERE id = ?", [(i,) for i in ids]))
+        with self._ready:
+            self.acked += len(ids)
+
+    def nack(self, ids: List[int]):
+        """Xử lý lỗi: thử lại sau retry_delay, quá max_attempts thì đánh dấu lỗi"""
+        self._drop_held(ids)
+        available = time.time() + self.retry_delay
+
+        def retry(db):
+            db.executemany("UPDATE webhook_events SET available = ? WHERE id = ?",
+                           [(available, i) for i in ids])
+            return db.execute(
+                f"UPDATE webhook_events SET state = {DEAD} WHERE id IN ({','.join('?' * len(ids))}) "
+                f"AND attempts >= ?", (*ids, self.max_attempts)).rowcount
+
+        dead = self._transaction(retry) if ids else 0
+        with self._ready:
+            self.retried += len(ids) - dead
+            self.dead += dead
+
+    def release(self, ids: List[int]):
+        """Trả lại tin nhắn chưa xử lý (VD: pool đầy), không tính là một lần thử"""
+        self._drop_held(ids)
+        available = time.time() + self.retry_delay
+        self._transaction(lambda db: db.executemany(
+            "UPDATE webhook_events SET available = ?, attempts = attempts - 1 WHERE id = ?",
+            [(available, i) for i in ids]))
+
+    def renew(self):
+        """Gia hạn lease các tin nhắn process này đang xử lý (gọi định kỳ từ consumer)"""
+        if time.monotonic() < self._next_renewal:
+            return
+        self._next_renewal = time.monotonic() + self.lease / 3
+
+        def extend(db):
+            # Lấy danh sách khi đang giữ khóa DB: ack/nack bỏ tin khỏi _held trước transaction của chúng,
+            # nên không gia hạn nhầm tin vừa nack (sẽ làm chậm lần thử lại)
+            with self._ready:
+                held = list(self._held.items())
+            available = time.time() + self.lease
+            before = db.total_changes
+            # attempts phải khớp: không gia hạn tin đã hết lease và được consumer khác lấy lại
+            db.executemany("UPDATE webhook_events SET available = ? WHERE id = ? AND attempts = ? AND state = 0",
+                           [(available, i, attempts) for i, attempts in held])
+            return len(held), db.total_changes - before
+
+        try:
+            count, renewed = self._transaction(extend)
+        except sqlite3.Error as e:
+            print(f"⚠️ Lỗi khi gia hạn lease hàng đợi webhook: {e}")
+            return
+        with self._ready:
+            self.renewed += renewed
+            self.lost += count - renewed
+
+    def wait(self, timeout: float):
+        """Chờ tin nhắn mới trong process này (tin từ worker khác thì consumer tự poll)"""
+        with self._ready:
+            self._ready.wait(timeout)
+
+    def maintain(self):
+        """Xóa tin nhắn lỗi quá retention (gọi định kỳ từ consumer)"""
+        if time.monotonic() < self._next_maintenance:
+            return
+        self._next_maintenance = time.monotonic() + self.MAINTENANCE_INTERVAL
+        try:
+            self._transaction(lambda db: db.execute(
+                "DELETE FROM webhook_events WHERE state != 0 AND received < ?",
+                (time.time() - self.retention,)))
+        except sqlite3.Error as e:
+            print(f"⚠️ Lỗi khi dọn hàng đợi webhook: {e}")
+
+    def close(self):
+        with self._db_lock:
+            if not self._closed:
+                self._closed = True
+                self._db.close()
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê hàng đợi webhook"""
+        now = time.time()
+        with self._db_lock:
+            pending, oldest = self._db.execute(
+                "SELECT COUNT(*), MIN(received) FROM webhook_events WHERE state = 0").fetchone()
+            dead_total = self._db.execute("SELECT COUNT(*) FROM webhook_events WHERE state = ?", (DEAD,)).fetchone()[0]
+        with self._ready:
+            return {
+                'pending': pending,
+                'oldest_pending_s': round(now - oldest, 1) if oldest is not None else 0.0,
+                'dead_letters': dead_total,
+                'enqueued': self.enqueued,
+                'duplicates': self.duplicates,
+                'claimed': self.claimed,
+                'acked': self.acked,
+                'retried': self.retried,
+                'dead': self.dead,
+                'held': len(self._held),
+                'renewed': self.renewed,
+                'lost': self.lost,
+            }
+
+
+class QueueConsumer:
+    """
+    Lấy tin nhắn từ WebhookQueue đưa cho worker pool
+    Chỉ lấy số tin nhắn bằng chỗ trống của pool; tin nhắn không đưa vào được
+    thì trả lại hàng đợi, tin nhắn đã lấy mà process chết thì hết lease sẽ được lấy lại.
+    """
+
+    def __init__(self, queue: WebhookQueue, dispatch: Callable[[Dict], bool],
+                 capacity: Callable[[], int], batch: int = 20, poll_interval: float = 0.5):
+        """
+        Args:
+            queue: Hàng đợi webhook
+            dispatch: Hàm nhận một tin nhắn đã lấy ra, trả về False nếu không nhận được
+            capacity: Số tin nhắn có thể nhận thêm lúc này
+            batch: Số tin nhắn tối đa mỗi lần lấy
+            poll_interval: Chu kỳ kiểm tra tin nhắn do worker khác ghi / tin hết lease (giây)
+        """
+        self.queue = queue
+        self.dispatch = dispatch
+        self.capacity = capacity
+        self.batch = batch
+        self.poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Chạy consumer trong thread riêng (chế độ đồng bộ)"""
+        thread = threading.Thread(target=self._run, name='webhook-consumer', daemon=True)
+        thread.start()
+
+    def stop(self):
+        """Ngừng lấy tin nhắn"""
+        self._stopped.set()
+
+    def _claim(self) -> List[Dict]:
+        return self.queue.claim(min(self.batch, self.capacity()))
+
+    def _hand_over(self, events: List[Dict]) -> List[int]:
+        """Đưa tin nhắn cho dispatch, trả về id các tin không nhận được"""
+        return [event['id'] for event in events if not self.dispatch(event)]
+
+    def _release(self, rejected: List[int]):
+        """Trả lại tin nhắn không nhận được, gia hạn lease tin đang xử lý và dọn hàng đợi định kỳ"""
+        if rejected:
+            self.queue.release(rejected)
+        self.queue.renew()
+        self.queue.maintain()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                events = self._claim()
+                self._release(self._hand_over(events))
+            except Exception as e:
+                print(f"❌ Lỗi khi đọc hàng đợi webhook: {e}")
+                events = []
+            if len(events) < self.batch:
+                self.queue.wait(self.poll_interval)
+
+    async def run_async(self, wakeup: asyncio.Event):
+        """
+        Chạy consumer trên event loop (chế độ ASGI): dispatch gọi trên loop,
+        các thao tác SQLite chạy trong thread pool để không chặn loop
+
+        Args:
+            wakeup: Event báo có tin nhắn mới do process này ghi
+        """
+        while not self._stopped.is_set():
+            try:
+                events = await asyncio.to_thread(self._claim)
+                await asyncio.to_thread(self._release, self._hand_over(events))
+            except Exception as e:
+                print(f"❌ Lỗi khi đọc hàng đợi webhook: {e}")
+                events = []
+            if len(events) < self.batch:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                wakeup.clear()
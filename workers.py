@@ -0,0 +1,234 @@
+"""
+Worker pool có giới hạn cho xử lý tin nhắn webhook
+Số thread và độ dài hàng đợi cố định, quá tải thì từ chối thay vì tạo thêm thread.
+Tin nhắn của cùng một người gửi được xử lý tuần tự và gộp lại (SenderDispatcher).
+"""
+
+import heapq
+import queue
+import threading
+import time
+from typing import Callable, Dict, List
+
+
+class WorkerPool:
+    def __init__(self, workers: int = 4, queue_size: int = 100, name: str = "worker"):
+        """
+        Khởi tạo worker pool
+
+        Args:
+            workers: Số thread xử lý đồng thời
+            queue_size: Số job tối đa được xếp hàng chờ
+            name: Tiền tố tên thread (để đọc log)
+        """
+        self.workers = workers
+        self.queue_size = queue_size
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+
+        # Số liệu backpressure
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            thread.start()
+
+    def submit(self, fn: Callable, *args) -> bool:
+        """
+        Đưa job vào hàng đợi
+
+        Returns:
+            bool: False nếu hàng đợi đầy (job bị từ chối)
+        """
+        try:
+            self._queue.put_nowait((fn, args, time.monotonic()))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def free_slots(self) -> int:
+        """Số job còn nhận được trước khi hàng đợi đầy"""
+        return max(0, self.queue_size - self._queue.qsize())
+
+    def _run(self):
+        while True:
+            fn, args, enqueued_at = self._queue.get()
+            wait = time.monotonic() - enqueued_at
+            with self._lock:
+                self.busy += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+            try:
+                fn(*args)
+                ok = True
+            except Exception as e:
+                print(f"❌ Lỗi khi xử lý job: {e}")
+                ok = False
+            finally:
+                self._queue.task_done()
+            with self._lock:
+                self.busy -= 1
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê hàng đợi"""
+        with self._lock:
+            started = self.completed + self.failed + self.busy
+            return {
+                'workers': self.workers,
+                'busy_workers': self.busy,
+                'queue_length': self._queue.qsize(),
+                'queue_size': self.queue_size,
+                'submitted': self.submitted,
+                'rejected': self.rejected,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_wait_ms': round(self.total_wait / started * 1000, 1) if started else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 1),
+            }
+
+
+class SenderDispatcher:
+    """
+    Xử lý tin nhắn tuần tự theo từng người gửi
+    Tin nhắn đến liên tiếp trong khoảng debounce được gộp thành một lần xử lý,
+    mỗi người gửi chỉ có tối đa một job chạy tại một thời điểm.
+    """
+
+    def __init__(self, pool: WorkerPool, handler: Callable[[str, List], None],
+                 debounce: float = 1.5, max_pending: int = 20, queue_size: int = None):
+        """
+        Args:
+            pool: Worker pool chạy các job
+            handler: Hàm xử lý handler(sender_id, [tin nhắn theo thứ tự])
+                (tin nhắn là giá trị truyền vào dispatch, VD: event từ hàng đợi webhook)
+            debounce: Số giây chờ thêm tin nhắn trước khi xử lý
+            max_pending: Số tin nhắn tối đa đang chờ cho một người gửi
+            queue_size: Số tin nhắn tối đa đã nhận mà chưa xử lý xong (mặc định bằng hàng đợi của pool)
+        """
+        self.pool = pool
+        self.queue_size = queue_size if queue_size is not None else pool.queue_size
+        self.handler = handler
+        self.debounce = debounce
+        self.max_wait = debounce * 3  # Không chờ quá lâu nếu khách nhắn liên tục
+        self.max_pending = max_pending
+        self._cond = threading.Condition()
+        self._senders: Dict[str, Dict] = {}  # sender_id -> trạng thái hàng đợi
+        self._schedule: List = []  # heap (thời điểm xử lý, sender_id)
+
+        self.in_flight = 0  # Tin nhắn đã nhận mà chưa xử lý xong (đang gộp, chờ pool hoặc đang chạy)
+        self.received = 0
+        self.batches = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+        thread = threading.Thread(target=self._run_scheduler, name="sender-scheduler", daemon=True)
+        thread.start()
+
+    def capacity(self) -> int:
+        """Số tin nhắn còn nhận được (tính cả tin đang chờ gộp trong debounce)"""
+        with self._cond:
+            return max(0, self.queue_size - self.in_flight)
+
+    def dispatch(self, sender_id: str, message) -> bool:
+        """
+        Thêm tin nhắn vào hàng đợi của người gửi
+
+        Returns:
+            bool: False nếu người gửi có quá nhiều tin nhắn đang chờ
+        """
+        now = time.monotonic()
+        with self._cond:
+            state = self._senders.get(sender_id)
+            if state is None:
+                state = self._senders[sender_id] = {
+                    'messages': [], 'first_at': now, 'due': now,
+                    'running': False, 'scheduled': False,
+                }
+            if len(state['messages']) >= self.max_pending:
+                self.dropped += 1
+                return False
+            if not state['messages']:
+                state['first_at'] = now
+            state['messages'].append(message)
+            state['due'] = min(now + self.debounce, state['first_at'] + self.max_wait)
+            self.received += 1
+            self.in_flight += 1
+            if not state['running'] and not state['scheduled']:
+                self._push(sender_id, state)
+        return True
+
+    def _push(self, sender_id: str, state: Dict):
+        state['scheduled'] = True
+        heapq.heappush(self._schedule, (state['due'], sender_id))
+        self._cond.notify()
+
+    def _run_scheduler(self):
+        with self._cond:
+            while True:
+                if not self._schedule:
+                    self._cond.wait()
+                    continue
+                due, sender_id = self._schedule[0]
+                state = self._senders[sender_id]
+                if state['due'] > due:
+                    # Có tin nhắn mới, lùi thời điểm xử lý
+                    heapq.heapreplace(self._schedule, (state['due'], sender_id))
+                    continue
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                heapq.heappop(self._schedule)
+                messages, state['messages'] = state['messages'], []
+                state['scheduled'] = False
+                state['running'] = True
+                if not self.pool.submit(self._process, sender_id, messages):
+                    print(f"⚠️ Hàng đợi đầy, bỏ qua {len(messages)} tin nhắn từ {sender_id}")
+                    self.dropped += len(messages)
+                    self.in_flight -= len(messages)
+                    self._finish(sender_id, state)
+
+    def _process(self, sender_id: str, messages: List[str]):
+        with self._cond:
+            self.batches += 1
+            self.coalesced += len(messages) - 1
+        try:
+            self.handler(sender_id, messages)
+        finally:
+            with self._cond:
+                self.in_flight -= len(messages)
+                self._finish(sender_id, self._senders[sender_id])
+
+    def _finish(self, sender_id: str, state: Dict):
+        """Kết thúc một lượt xử lý; gọi khi đang giữ self._cond"""
+        state['running'] = False
+        if state['messages']:
+            self._push(sender_id, state)
+        else:
+            del self._senders[sender_id]
+
+    def get_stats(self) -> Dict:
+        """Lấy thống kê gộp tin nhắn"""
+        with self._cond:
+            return {
+                'active_senders': len(self._senders),
+                'in_flight': self.in_flight,
+                'received': self.received,
+                'batches': self.batches,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+            }